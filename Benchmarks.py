@@ -0,0 +1,372 @@
+import time
+import numpy as np
+
+def synthetic_progression_events(n_events, pitch_length=120, pitch_width=80, seed=0):
+
+    '''
+    Creates a dataframe of random ball progressions with x and y vertical start and end locations.
+    End locations move towards y = 0 by a typical pass or carry distance and are kept on the pitch.
+
+    Parameters:
+        n_events (integer): number of events to create
+        pitch_length (integer): length of pitch in yards
+        pitch_width (integer): width of pitch in yards
+        seed (integer): seed for the random number generator
+
+    '''
+
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+
+    x_start = rng.uniform(0, pitch_width, n_events)
+    y_start = rng.uniform(0, pitch_length, n_events)
+    x_end = np.clip(x_start + rng.normal(0, 10, n_events), 0, pitch_width)
+    y_end = np.clip(y_start - np.abs(rng.normal(0, 20, n_events)), 0, pitch_length)
+
+    events_df = pd.DataFrame({'vertical_location_x': x_start,
+                              'vertical_location_y': y_start,
+                              'vertical_end_location_x': x_end,
+                              'vertical_end_location_y': y_end})
+
+    return events_df
+
+
+def synthetic_statsbomb_events(n_events, pitch_length=120, pitch_width=80, seed=0):
+
+    '''
+    Creates a dataframe shaped like prepared StatsBomb events: random ball progressions from synthetic_progression_events()
+    with id, match, team, player and event type columns, about 3,500 events per match.
+
+    Parameters:
+        n_events (integer): number of events to create
+        pitch_length (integer): length of pitch in yards
+        pitch_width (integer): width of pitch in yards
+        seed (integer): seed for the random number generator
+
+    '''
+
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    teams = ['Arsenal', 'Chelsea', 'Liverpool', 'Manchester United', 'Newcastle United', 'Tottenham Hotspur']
+
+    events_df = synthetic_progression_events(n_events, pitch_length, pitch_width, seed=seed)
+    events_df.insert(0, 'id', np.arange(n_events))
+    events_df.insert(1, 'match_id', 3749000 + np.arange(n_events) // 3500)
+    events_df.insert(2, 'team_name', pd.Categorical.from_codes(rng.integers(0, len(teams), n_events), teams))
+    events_df.insert(3, 'player_id', rng.integers(3000, 3300, n_events))
+    events_df.insert(4, 'type_name', pd.Categorical.from_codes(rng.integers(0, 2, n_events), ['Pass', 'Carry']))
+
+    return events_df
+
+
+def time_figure_draw(plot_function, *args, **kwargs):
+
+    '''
+    Times a plotting function from call until the figure canvas has been drawn, then closes the figure.
+
+    Parameters:
+        plot_function (function): plotting function returning fig as first output
+        args, kwargs: passed to plot_function
+
+    '''
+
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    output = plot_function(*args, **kwargs)
+    fig = output[0]
+    fig.canvas.draw()
+    elapsed = time.perf_counter() - start
+    plt.close(fig)
+
+    return elapsed
+
+
+def benchmark_event_arrows(event_counts=(100, 1000, 10000, 100000), annotate_max_events=10000, seed=0):
+
+    '''
+    Compares annotate and collection rendering of plot_sb_events across numbers of events.
+    The annotate path is skipped above annotate_max_events as it takes minutes to draw.
+
+    Parameters:
+        event_counts (tuple): numbers of events to render
+        annotate_max_events (integer): largest number of events to render with annotate
+        seed (integer): seed for the random number generator
+
+    '''
+
+    import pandas as pd
+    from StatsBombViz import plot_sb_events
+
+    results = []
+    for n_events in event_counts:
+        events_df = synthetic_progression_events(n_events, seed=seed)
+        for render in ['annotate', 'collection']:
+            if render == 'annotate' and n_events > annotate_max_events:
+                continue
+            seconds = time_figure_draw(plot_sb_events, events_df, render=render)
+            results.append({'Events': n_events, 'Render': render, 'Seconds': seconds})
+
+    return pd.DataFrame(results)
+
+
+def benchmark_pitches(pitch_counts=(1, 16, 256)):
+
+    '''
+    Times drawing a grid of vertical pitches on one figure for each number of pitches.
+
+    Parameters:
+        pitch_counts (tuple): numbers of pitches per figure
+
+    '''
+
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    from CustomPitch import createVerticalPitch
+
+    def draw_pitch_grid(n_pitches):
+        cols = int(np.ceil(np.sqrt(n_pitches)))
+        rows = int(np.ceil(n_pitches / cols))
+        fig, axs = plt.subplots(rows, cols, figsize=(2 * cols, 3 * rows), squeeze=False)
+        for ax in axs.flat[:n_pitches]:
+            createVerticalPitch(figax=(fig, ax))
+        return fig, axs
+
+    results = []
+    for n_pitches in pitch_counts:
+        seconds = time_figure_draw(draw_pitch_grid, n_pitches)
+        results.append({'Pitches': n_pitches, 'Seconds': seconds, 'Seconds per Pitch': seconds / n_pitches})
+
+    return pd.DataFrame(results)
+
+
+def benchmark_cluster_evaluation(n_events=5000, max_clusters=20, n_jobs_list=(1, -1), seed=0):
+
+    '''
+    Times the cluster_evaluation k sweep for each number of worker processes and checks each matches the serial result.
+
+    Parameters:
+        n_events (integer): number of events to cluster
+        max_clusters (integer): maximum number of clusters to evaluate for k-means
+        n_jobs_list (tuple): numbers of worker processes to compare, -1 to use all cores
+        seed (integer): seed for the random number generator and k-means
+
+    '''
+
+    import pandas as pd
+    from ClusterEval import cluster_evaluation
+
+    events_df = synthetic_progression_events(n_events, seed=seed)
+
+    results = []
+    serial_df = None
+    for n_jobs in n_jobs_list:
+        start = time.perf_counter()
+        cluster_evaluation_df = cluster_evaluation(events_df, max_clusters, n_jobs=n_jobs, random_state=seed)
+        seconds = time.perf_counter() - start
+        if serial_df is None:
+            serial_df = cluster_evaluation_df
+        results.append({'Events': n_events, 'Jobs': n_jobs, 'Seconds': seconds,
+                        'Matches Serial': cluster_evaluation_df.equals(serial_df)})
+
+    benchmark_df = pd.DataFrame(results)
+    benchmark_df['Speedup'] = benchmark_df['Seconds'].iloc[0] / benchmark_df['Seconds']
+
+    return benchmark_df
+
+
+def benchmark_kmeans_sweep(n_events=20000, max_clusters=50, seed=0):
+
+    '''
+    Compares fitting k-means from scratch for every number of clusters against the warm started incremental sweep.
+    Only fitting is timed, the evaluation measures are left out.
+
+    Parameters:
+        n_events (integer): number of events to cluster
+        max_clusters (integer): maximum number of clusters to evaluate for k-means
+        seed (integer): seed for the random number generator and k-means
+
+    '''
+
+    import pandas as pd
+    from sklearn.cluster import KMeans
+    from ClusterEval import incremental_kmeans_sweep
+
+    events_locations = synthetic_progression_events(n_events, seed=seed).to_numpy()
+
+    results = []
+    start = time.perf_counter()
+    for clusters in range(2, max_clusters):
+        inertia = KMeans(n_clusters=clusters, random_state=seed).fit(events_locations).inertia_
+    results.append({'Sweep': 'independent', 'Seconds': time.perf_counter() - start, 'Final Sum of Squares': inertia})
+
+    for backend in ['lloyd', 'minibatch']:
+        start = time.perf_counter()
+        for clusters, cluster_labels, centroids, inertia in incremental_kmeans_sweep(events_locations, max_clusters,
+                                                                                     backend=backend, random_state=seed):
+            pass
+        results.append({'Sweep': 'incremental ' + backend, 'Seconds': time.perf_counter() - start, 'Final Sum of Squares': inertia})
+
+    return pd.DataFrame(results)
+
+
+def benchmark_imports(budget_seconds=None, repeat=3):
+
+    '''
+    Times importing each project module in a fresh interpreter and lists the heavy libraries each one loads.
+    Heavy libraries load on first use, so only StatsBombViz should load NumPy at import and none should load pandas,
+    Matplotlib, SciPy or scikit-learn. The best of repeat runs is compared against each module's budget.
+
+    Parameters:
+        budget_seconds (dict): module name to import time budget in seconds, None for the defaults
+        repeat (integer): number of fresh interpreters to time each import in
+
+    '''
+
+    import os
+    import sys
+    import json
+    import subprocess
+    import pandas as pd
+
+    if budget_seconds is None:
+        budget_seconds = {'Instrumentation': 0.05, 'StatsBombPrep': 0.05, 'ClusterEval': 0.05, 'CustomPitch': 0.05, 'StatsBombViz': 0.3}
+
+    heavy_modules = ['numpy', 'pandas', 'matplotlib', 'scipy', 'sklearn', 'seaborn']
+    code = ('import sys, time, json\n'
+            'start = time.perf_counter()\n'
+            'import {module}\n'
+            'seconds = time.perf_counter() - start\n'
+            'print(json.dumps([seconds, [name for name in {heavy_modules} if name in sys.modules]]))')
+
+    results = []
+    for module, budget in budget_seconds.items():
+        runs = [json.loads(subprocess.run([sys.executable, '-c', code.format(module=module, heavy_modules=heavy_modules)],
+                                          cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                                          check=True).stdout)
+                for run in range(repeat)]
+        seconds = min(seconds for seconds, loaded in runs)
+        results.append({'Module': module, 'Seconds': seconds, 'Budget Seconds': budget, 'Within Budget': seconds <= budget,
+                        'Heavy Modules': ', '.join(runs[0][1])})
+
+    return pd.DataFrame(results)
+
+
+def measure_call(function, *args, repeat=1, trace_memory=True, **kwargs):
+
+    '''
+    Measures a call's best wall time over repeat runs, then its peak traced memory in one more run.
+    Memory is measured separately because tracing slows Python code, it covers Python and NumPy allocations only.
+
+    Parameters:
+        function (function): function to measure
+        args, kwargs: passed to function
+        repeat (integer): number of timed runs
+        trace_memory (boolean): run once more with tracemalloc to find peak memory
+
+    '''
+
+    import gc
+    import tracemalloc
+
+    seconds = []
+    for run in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        seconds.append(time.perf_counter() - start)
+
+    peak_mb = None
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function(*args, **kwargs)
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+
+    return min(seconds), peak_mb
+
+
+def benchmark_suite(row_counts=(1000, 10000, 100000, 1000000), output_file='benchmark_results.jsonl', repeat=1,
+                    trace_memory=True, seed=0):
+
+    '''
+    Times the prep, clustering and rendering hot paths on synthetic StatsBomb shaped events at each number of rows,
+    recording wall time and peak memory. Plotting cases include drawing the canvas.
+    Results are appended to a json lines file with the library versions, so runs can be compared over time.
+    Slow cases only run up to a row limit: annotate arrows to 1k rows and full silhouette evaluation to 10k rows,
+    beyond that the silhouette is estimated from 1,000 sampled events.
+
+    Parameters:
+        row_counts (tuple): numbers of events to benchmark
+        output_file (string): json lines file to append results to, None to not write
+        repeat (integer): number of timed runs per case, the best is kept
+        trace_memory (boolean): measure peak memory of each case
+        seed (integer): seed for the random number generator and clustering
+
+    '''
+
+    import sys
+    import json
+    import platform
+    from datetime import datetime, timezone
+    import pandas as pd
+    import matplotlib
+    import sklearn
+    from CustomPitch import createVerticalPitch
+    from StatsBombPrep import ball_progression_events_into_thirds
+    from StatsBombViz import plot_sb_events, plot_sb_event_location
+    from ClusterEval import kmeans_cluster, cluster_evaluation
+
+    # (case, function, keyword arguments, maximum rows, whether the function draws a figure)
+    cases = [('ball_progression_events_into_thirds', ball_progression_events_into_thirds, {}, None, False),
+             ('kmeans_cluster', kmeans_cluster, {'clusters': 4}, None, False),
+             ('cluster_evaluation full', cluster_evaluation, {'max_clusters': 6, 'random_state': seed}, 10000, False),
+             ('cluster_evaluation sampled', cluster_evaluation,
+              {'max_clusters': 6, 'random_state': seed, 'silhouette_method': 'sampled', 'silhouette_sample_size': 1000}, None, False),
+             ('plot_sb_events annotate', plot_sb_events, {'render': 'annotate'}, 1000, True),
+             ('plot_sb_events collection', plot_sb_events, {'render': 'collection'}, None, True),
+             ('plot_sb_event_location', plot_sb_event_location, {}, None, True)]
+
+    run = {'Run': datetime.now(timezone.utc).isoformat(), 'Python': platform.python_version(), 'Platform': platform.platform(),
+           'numpy': np.__version__, 'pandas': pd.__version__, 'scikit-learn': sklearn.__version__, 'matplotlib': matplotlib.__version__}
+
+    results = []
+    seconds, peak_mb = measure_call(time_figure_draw, createVerticalPitch, repeat=repeat, trace_memory=trace_memory)
+    results.append(dict(run, Case='createVerticalPitch', Rows=0, Seconds=seconds, **{'Peak MB': peak_mb}))
+
+    for n_rows in row_counts:
+        events_df = synthetic_statsbomb_events(n_rows, seed=seed)
+        for case, function, kwargs, max_rows, draws in cases:
+            if max_rows is not None and n_rows > max_rows:
+                continue
+            if draws:
+                seconds, peak_mb = measure_call(time_figure_draw, function, events_df, repeat=repeat, trace_memory=trace_memory, **kwargs)
+            else:
+                seconds, peak_mb = measure_call(function, events_df, repeat=repeat, trace_memory=trace_memory, **kwargs)
+            results.append(dict(run, Case=case, Rows=n_rows, Seconds=seconds, **{'Peak MB': peak_mb}))
+            print(case, n_rows, round(seconds, 3), file=sys.stderr)
+
+    if output_file is not None:
+        with open(output_file, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+    print(benchmark_imports())
+    print(benchmark_suite()[['Case', 'Rows', 'Seconds', 'Peak MB']])
+    print(benchmark_event_arrows())
+    print(benchmark_pitches())
+    print(benchmark_cluster_evaluation())
+    print(benchmark_kmeans_sweep())
@@ -1,5 +1,6 @@
-from sklearn import metrics
+from Instrumentation import instrumented, stage, worker_function, worker_output
 
+@instrumented
 def kmeans_cluster(events_df, clusters=4):
     
     '''
@@ -23,106 +24,796 @@ def kmeans_cluster(events_df, clusters=4):
     return cluster_labels
 
 
-def cluster_colour_map(cluster_labels, clusters):
+@instrumented
+def fit_cluster_model(events_df, clusters=4, scale=False, random_state=None):
     
     '''
-    Maps each cluster label to a random colour.
+    Fits k-means to events start and end vertical locations and keeps the fitted model as a dict,
+    so new events can be assigned to the same clusters with predict_cluster_labels() instead of refitting.
+    
+    Model keys:
+        centroids: cluster centroids in scaled units, one row per cluster
+        counts: number of events assigned to each cluster so far, used by partial_fit_cluster_model()
+        scaler_mean, scaler_scale: standardisation applied to locations before clustering, zeros and ones if not scaled
+        metadata: columns, clusters, number of events, random_state and creation time
     
     Parameter:
-        cluster_labels (list): list of assigned cluster labels
+        events_df (dataframe): event dataframe with x and y vertical locations
         clusters (integer): number of clusters to use for k-means
+        scale (boolean): standardise each location column before clustering
+        random_state (integer): seed for k-means
 
     '''
     
     import numpy as np
+    from datetime import datetime, timezone
+    from sklearn.cluster import KMeans
+    
+    columns = ['vertical_location_x', 'vertical_location_y', 'vertical_end_location_x', 'vertical_end_location_y']
+    events_locations = events_df[columns].to_numpy(dtype=float)
     
-    cluster_colour_dict = {}
+    if scale:
+        scaler_mean = events_locations.mean(axis=0)
+        scaler_scale = events_locations.std(axis=0)
+        scaler_scale[scaler_scale == 0] = 1
+    else:
+        scaler_mean = np.zeros(len(columns))
+        scaler_scale = np.ones(len(columns))
     
-    for cluster in range(clusters):
-        random_colour = np.random.rand(3,)
-        cluster_colour_dict[cluster] = random_colour
+    kmeans = KMeans(n_clusters=clusters, random_state=random_state)
+    kmeans.fit((events_locations - scaler_mean) / scaler_scale)
+    
+    cluster_model = {'centroids': kmeans.cluster_centers_,
+                     'counts': np.bincount(kmeans.labels_, minlength=clusters),
+                     'scaler_mean': scaler_mean,
+                     'scaler_scale': scaler_scale,
+                     'metadata': {'columns': columns,
+                                  'clusters': clusters,
+                                  'n_events': len(events_locations),
+                                  'random_state': None if random_state is None else int(random_state),
+                                  'created': datetime.now(timezone.utc).isoformat()}}
+    
+    return cluster_model
 
-    label_colour = [cluster_colour_dict[l] for l in cluster_labels]
 
-    return label_colour
+def save_cluster_model(cluster_model, path):
+    
+    '''
+    Saves a cluster model from fit_cluster_model() to a NumPy .npz file, arrays as they are and metadata as json.
+    Nothing is pickled, so models can be loaded safely and shared between versions.
+    
+    Parameter:
+        cluster_model (dict): fitted cluster model
+        path (string): file path to save to, .npz is added if missing
+
+    '''
+    
+    import json
+    import numpy as np
+    
+    np.savez(path, centroids=cluster_model['centroids'], counts=cluster_model['counts'],
+             scaler_mean=cluster_model['scaler_mean'], scaler_scale=cluster_model['scaler_scale'],
+             metadata=json.dumps(cluster_model['metadata']))
 
 
-def cluster_evaluation(events_df, max_clusters):
+def load_cluster_model(path):
     
     '''
-    Applies k-means clustering to events start and end vertical locations using all numbers of clusters up to max_clusters.
-    Cluster evaluation measures are calculated and stored in dataframe.
+    Loads a cluster model saved by save_cluster_model().
+    
+    Parameter:
+        path (string): file path of the saved model
+
+    '''
+    
+    import json
+    import numpy as np
+    
+    with np.load(path, allow_pickle=False) as saved:
+        cluster_model = {'centroids': saved['centroids'],
+                         'counts': saved['counts'],
+                         'scaler_mean': saved['scaler_mean'],
+                         'scaler_scale': saved['scaler_scale'],
+                         'metadata': json.loads(saved['metadata'].item())}
+    
+    return cluster_model
+
+
+def cluster_model_locations(cluster_model, events_df):
+    
+    '''
+    Reads the event locations used by a fitted cluster model and applies its standardisation.
+    Raises a ValueError for missing or infinite locations, as sklearn KMeans does, so they never reach a centroid.
     
     Parameter:
+        cluster_model (dict): fitted cluster model from fit_cluster_model() or load_cluster_model()
         events_df (dataframe): event dataframe with x and y vertical locations
-        max_clusters (integer): maximum number of clusters to evaluate for k-means
 
     '''
     
-    import pandas as pd
-    from sklearn.cluster import KMeans
+    import numpy as np
+    
+    events_locations = events_df[cluster_model['metadata']['columns']].to_numpy(dtype=float)
+    if not np.isfinite(events_locations).all():
+        raise ValueError('events_df has missing or infinite locations, drop them before predicting or updating clusters')
+    
+    return (events_locations - cluster_model['scaler_mean']) / cluster_model['scaler_scale']
+
+
+@instrumented
+def predict_cluster_labels(cluster_model, events_df):
+    
+    '''
+    Assigns events to the nearest centroid of a fitted cluster model, without changing the model.
+    
+    Parameter:
+        cluster_model (dict): fitted cluster model from fit_cluster_model() or load_cluster_model()
+        events_df (dataframe): event dataframe with x and y vertical locations
+
+    '''
+    
+    events_locations = cluster_model_locations(cluster_model, events_df)
+    
+    # Event norms are the same for every centroid, so they are left out of the distances
+    centroids = cluster_model['centroids']
+    distances = events_locations @ (-2 * centroids.T)
+    distances += (centroids ** 2).sum(axis=1)
+    cluster_labels = distances.argmin(axis=1)
+    
+    return cluster_labels
+
+
+@instrumented
+def partial_fit_cluster_model(cluster_model, events_df):
+    
+    '''
+    Updates a fitted cluster model with new events and returns the updated model, the given model is not changed.
+    Each centroid moves to the mean of all events assigned to it so far, as in sequential k-means,
+    so existing clusters keep their numbers and labels stay comparable between runs.
+    
+    Parameter:
+        cluster_model (dict): fitted cluster model from fit_cluster_model() or load_cluster_model()
+        events_df (dataframe): event dataframe with x and y vertical locations of new events
+
+    '''
+    
+    import numpy as np
+    
+    clusters = len(cluster_model['centroids'])
+    events_locations = cluster_model_locations(cluster_model, events_df)
+    cluster_labels = predict_cluster_labels(cluster_model, events_df)
+    
+    new_counts = np.bincount(cluster_labels, minlength=clusters)
+    new_sums = np.column_stack([np.bincount(cluster_labels, weights=column, minlength=clusters)
+                                for column in events_locations.T])
+    counts = cluster_model['counts'] + new_counts
+    centroids = np.where(new_counts[:, np.newaxis] > 0,
+                         (cluster_model['centroids'] * cluster_model['counts'][:, np.newaxis] + new_sums) / np.maximum(counts, 1)[:, np.newaxis],
+                         cluster_model['centroids'])
+    
+    metadata = dict(cluster_model['metadata'])
+    metadata['n_events'] = metadata['n_events'] + len(events_locations)
+    
+    return dict(cluster_model, centroids=centroids, counts=counts, metadata=metadata)
+
+
+@instrumented
+def agglomerative_linkage(events_df, linkage='ward'):
+    
+    '''
+    Builds the agglomerative clustering tree of events start and end vertical locations.
+    The tree can be passed to agglomerative_cluster() and cluster_evaluation() to cut at any distance threshold without refitting.
+    
+    Parameter:
+        events_df (dataframe): event dataframe with x and y vertical locations
+        linkage (string): linkage criterion, 'ward', 'complete', 'average' or 'single'
+
+    '''
+    
+    from scipy.cluster import hierarchy
+    
+    events_locations = events_df[['vertical_location_x', 'vertical_location_y', 'vertical_end_location_x', 'vertical_end_location_y']].to_numpy()
+    
+    linkage_matrix = hierarchy.linkage(events_locations, method=linkage)
+    
+    return linkage_matrix
+
+
+def agglomerative_cluster(events_df, distance_threshold, linkage='ward', linkage_matrix=None):
+    
+    '''
+    Applies agglomerative clustering to events start and end vertical locations and returns cluster labels.
+    Clusters are found by cutting the tree at the distance threshold, matching sklearn AgglomerativeClustering.
+    
+    Parameter:
+        events_df (dataframe): event dataframe with x and y vertical locations
+        distance_threshold (numeric): linkage distance above which clusters are not merged
+        linkage (string): linkage criterion, 'ward', 'complete', 'average' or 'single'
+        linkage_matrix (array): tree from agglomerative_linkage() to reuse, None to build it
+
+    '''
+    
+    from scipy.cluster import hierarchy
+    
+    if linkage_matrix is None:
+        linkage_matrix = agglomerative_linkage(events_df, linkage)
+    
+    cluster_labels = hierarchy.fcluster(linkage_matrix, distance_threshold, criterion='distance') - 1
+    
+    return cluster_labels
+
+
+def cluster_palette(clusters):
+    
+    '''
+    Creates a fixed palette of RGBA colours, one row per cluster.
+    The first 20 colours are Matplotlib's tab10 then the light tab20 colours, the rest step round the hue circle by the golden ratio,
+    so colour i is the same whatever the number of clusters.
+    
+    Parameter:
+        clusters (integer): number of colours
+
+    '''
+    
+    import numpy as np
+    from matplotlib import colormaps
+    from matplotlib.colors import hsv_to_rgb
+    
+    palette = np.vstack([colormaps['tab10'].colors, colormaps['tab20'].colors[1::2]])
+    if clusters > len(palette):
+        hues = (np.arange(len(palette), clusters) * 0.618033988749895) % 1
+        extra = hsv_to_rgb(np.column_stack([hues, np.full_like(hues, 0.65), np.full_like(hues, 0.85)]))
+        palette = np.vstack([palette, extra])
+    
+    return np.column_stack([palette[:clusters], np.ones(clusters)])
+
+
+def cluster_centroids(events_locations, cluster_labels, clusters=None):
+    
+    '''
+    Calculates the mean location of each cluster, one row per cluster label.
+    
+    Parameter:
+        events_locations (array): events start and end vertical locations
+        cluster_labels (list): list of assigned cluster labels
+        clusters (integer): number of clusters, defaults to the largest label + 1
+
+    '''
+    
+    import numpy as np
+    
+    events_locations = np.asarray(events_locations, dtype=float)
+    cluster_labels = np.asarray(cluster_labels)
+    if clusters is None:
+        clusters = cluster_labels.max() + 1
+    
+    counts = np.bincount(cluster_labels, minlength=clusters)
+    centroids = np.column_stack([np.bincount(cluster_labels, weights=column, minlength=clusters)
+                                 for column in events_locations.T])
+    
+    return centroids / np.maximum(counts, 1)[:, None]
+
+
+def match_cluster_centroids(centroids, reference_centroids):
+    
+    '''
+    Matches clusters to the clusters of a previous run by pairing up the closest centroids, minimising the total distance.
+    Returns the reference cluster for each cluster, extra clusters get new numbers after the reference clusters.
+    
+    Parameter:
+        centroids (array): cluster centroids, one row per cluster
+        reference_centroids (array): centroids of the previous run to match to
+
+    '''
+    
+    import numpy as np
+    from scipy.optimize import linear_sum_assignment
+    from scipy.spatial.distance import cdist
+    
+    centroids = np.asarray(centroids, dtype=float)
+    reference_centroids = np.asarray(reference_centroids, dtype=float)
+    
+    rows, cols = linear_sum_assignment(cdist(centroids, reference_centroids))
+    
+    cluster_match = np.full(len(centroids), -1)
+    cluster_match[rows] = cols
+    unmatched = cluster_match == -1
+    cluster_match[unmatched] = len(reference_centroids) + np.arange(unmatched.sum())
+    
+    return cluster_match
+
+
+def cluster_colour_order(centroids, pitch_length=120, pitch_width=80):
+    
+    '''
+    Puts clusters in a fixed order by matching their centroids to a fixed set of anchor locations spread over the pitch,
+    the first points of a Halton sequence. Returns the position of each cluster in that order.
+    Matching minimises the total distance, so small centroid shifts between runs do not reorder the clusters
+    unless two assignments are nearly tied.
+    
+    Parameter:
+        centroids (array): cluster centroids of start and end vertical locations, one row per cluster
+        pitch_length (integer): length of pitch in yards
+        pitch_width (integer): width of pitch in yards
+
+    '''
+    
+    import numpy as np
+    from scipy.stats import qmc
+    
+    centroids = np.asarray(centroids, dtype=float)
+    pitch_size = np.resize([pitch_width, pitch_length], centroids.shape[1])
+    anchors = qmc.Halton(d=centroids.shape[1], scramble=False).random(len(centroids)) * pitch_size
+    
+    return match_cluster_centroids(centroids, anchors)
+
+
+def cluster_colour_map(cluster_labels, clusters, centroids=None, reference_centroids=None):
+    
+    '''
+    Maps each cluster label to a colour from cluster_palette() and returns an (events, 4) array of RGBA colours.
+    Label numbers are arbitrary between runs, so given centroids the clusters are put in a fixed order first,
+    see cluster_colour_order(). Given reference_centroids from a previous run, each cluster takes the colour of the
+    reference cluster it matches, and extra clusters take new colours.
+    Re-running similar clusters then gives the same colours.
+    
+    Parameter:
+        cluster_labels (list): list of assigned cluster labels
+        clusters (integer): number of clusters to use for k-means
+        centroids (array): cluster centroids, one row per cluster, see cluster_centroids()
+        reference_centroids (array): centroids of a previous run whose colours should be kept
+
+    '''
+    
+    import numpy as np
+    
+    if centroids is None:
+        cluster_order = np.arange(clusters)
+    elif reference_centroids is None:
+        cluster_order = cluster_colour_order(centroids)
+    else:
+        # Reference clusters were coloured by their own order, so carry that order through the match
+        reference_order = cluster_colour_order(reference_centroids)
+        cluster_match = match_cluster_centroids(centroids, reference_centroids)
+        matched = cluster_match < len(reference_centroids)
+        cluster_order = np.where(matched, reference_order[np.minimum(cluster_match, len(reference_centroids) - 1)], cluster_match)
+    
+    palette = cluster_palette(cluster_order.max() + 1)
+    label_colour = palette[cluster_order[np.asarray(cluster_labels)]]
+
+    return label_colour
+
+
+def silhouette_samples_chunked(events_locations, cluster_labels, sample_index=None, memory_cap_mb=256):
+    
+    '''
+    Calculates the silhouette coefficient of each sampled event against all events.
+    The pairwise distance matrix is streamed in row chunks so it never uses more than memory_cap_mb.
+    Events in single event clusters score 0, as in sklearn.
+    
+    Parameter:
+        events_locations (array): event start and end vertical locations
+        cluster_labels (list): list of assigned cluster labels
+        sample_index (array): row positions of events to score, None for all events
+        memory_cap_mb (numeric): memory limit in megabytes for each chunk of the distance matrix
+
+    '''
+    
+    import numpy as np
+    from sklearn.metrics.pairwise import euclidean_distances
+    
+    events_locations = np.asarray(events_locations, dtype=float)
+    _, cluster_index, cluster_sizes = np.unique(cluster_labels, return_inverse=True, return_counts=True)
+    if sample_index is None:
+        sample_index = np.arange(len(events_locations))
+    
+    # Sort events by cluster so per cluster distance sums are a single reduceat over each chunk
+    order = np.argsort(cluster_index, kind='stable')
+    sorted_locations = events_locations[order]
+    sorted_norms = (sorted_locations ** 2).sum(axis=1)[np.newaxis, :]
+    cluster_starts = np.concatenate([[0], np.cumsum(cluster_sizes)[:-1]])
+    
+    # Distance chunk plus one working copy of the same size
+    chunk_rows = max(1, int(memory_cap_mb * 2**20 // (16 * len(events_locations))))
+    
+    silhouette = np.zeros(len(sample_index))
+    for chunk_start in range(0, len(sample_index), chunk_rows):
+        chunk = sample_index[chunk_start:chunk_start + chunk_rows]
+        distances = euclidean_distances(events_locations[chunk], sorted_locations, Y_norm_squared=sorted_norms)
+        cluster_distances = np.add.reduceat(distances, cluster_starts, axis=1)
+        del distances
+        
+        rows = np.arange(len(chunk))
+        own_cluster = cluster_index[chunk]
+        own_size = cluster_sizes[own_cluster]
+        intra = cluster_distances[rows, own_cluster] / np.maximum(own_size - 1, 1)
+        cluster_distances /= cluster_sizes
+        cluster_distances[rows, own_cluster] = np.inf
+        inter = cluster_distances.min(axis=1)
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chunk_silhouette = (inter - intra) / np.maximum(intra, inter)
+        silhouette[chunk_start:chunk_start + chunk_rows] = np.where(own_size > 1, np.nan_to_num(chunk_silhouette), 0)
+    
+    return silhouette
+
+
+def silhouette_evaluation(events_locations, cluster_labels, method='full', sample_size=10000, memory_cap_mb=256, random_state=None):
+    
+    '''
+    Calculates the silhouette coefficient with a 95% confidence interval, stating the method and number of events used.
+    The full and chunked methods are exact, so their Silhouette Lower and Upper are NaN.
+    
+    Methods:
+        full: sklearn silhouette_score over all events
+        chunked: exact silhouette over all events with the distance matrix streamed under memory_cap_mb
+        sampled: events sampled in proportion to each cluster and scored against all events,
+                 with a stratified confidence interval
+    
+    Parameter:
+        events_locations (array): event start and end vertical locations
+        cluster_labels (list): list of assigned cluster labels
+        method (string): specify 'full', 'chunked' or 'sampled'
+        sample_size (integer): number of events to score for the sampled method
+        memory_cap_mb (numeric): memory limit in megabytes for each chunk of the distance matrix
+        random_state (integer): seed for sampling events
+
+    '''
+    
+    import numpy as np
     from sklearn import metrics
     
-    events_locations = events_df[['vertical_location_x', 'vertical_location_y', 'vertical_end_location_x', 'vertical_end_location_y']]
+    n_events = len(events_locations)
+    
+    if method == 'full':
+        silhouette = metrics.silhouette_score(events_locations, cluster_labels, metric='euclidean')
+        lower, upper = np.nan, np.nan
+        n_scored = n_events
+    elif method == 'chunked':
+        silhouette = silhouette_samples_chunked(events_locations, cluster_labels, memory_cap_mb=memory_cap_mb).mean()
+        lower, upper = np.nan, np.nan
+        n_scored = n_events
+    elif method == 'sampled':
+        rng = np.random.default_rng(random_state)
+        cluster_labels = np.asarray(cluster_labels)
+        sample_fraction = min(1, sample_size / n_events)
+        
+        strata = []
+        for cluster in np.unique(cluster_labels):
+            cluster_rows = np.flatnonzero(cluster_labels == cluster)
+            n_sample = min(len(cluster_rows), max(2, int(round(sample_fraction * len(cluster_rows)))))
+            strata.append((cluster_rows, rng.choice(cluster_rows, n_sample, replace=False)))
+        
+        sample_index = np.concatenate([sample_rows for cluster_rows, sample_rows in strata])
+        sample_silhouette = silhouette_samples_chunked(events_locations, cluster_labels, sample_index, memory_cap_mb)
+        
+        # Stratified mean and variance with finite population correction
+        silhouette, variance, position = 0, 0, 0
+        for cluster_rows, sample_rows in strata:
+            stratum = sample_silhouette[position:position + len(sample_rows)]
+            position += len(sample_rows)
+            weight = len(cluster_rows) / n_events
+            silhouette += weight * stratum.mean()
+            if len(sample_rows) > 1:
+                variance += weight**2 * stratum.var(ddof=1) / len(sample_rows) * (1 - len(sample_rows) / len(cluster_rows))
+        
+        lower, upper = silhouette - 1.96 * np.sqrt(variance), silhouette + 1.96 * np.sqrt(variance)
+        n_scored = len(sample_index)
+    else:
+        raise ValueError("method must be 'full', 'chunked' or 'sampled'")
+    
+    silhouette_dict = {'Silhouette Coefficient': silhouette,
+                       'Silhouette Lower': lower,
+                       'Silhouette Upper': upper,
+                       'Silhouette Method': method,
+                       'Silhouette Sample Size': n_scored}
+    
+    return silhouette_dict
+
+
+def incremental_kmeans_sweep(events_locations, max_clusters, backend='lloyd', batch_size=1024, max_iter=300, tol=1e-4, random_state=None):
+    
+    '''
+    Fits k-means for all numbers of clusters from 2 up to max_clusters, warm starting each from the previous solution.
+    The k + 1 centroids are the k centroids with the cluster of largest sum of squares split in two along its main axis,
+    and each fit is a single sklearn run started from them, so it only needs a few iterations to settle.
+    Yields (clusters, cluster_labels, centroids, inertia) for each number of clusters.
+    
+    Parameter:
+        events_locations (array): event start and end vertical locations
+        max_clusters (integer): maximum number of clusters to evaluate for k-means, exclusive as in cluster_evaluation()
+        backend (string): specify 'lloyd' for sklearn KMeans or 'minibatch' for sklearn MiniBatchKMeans on very large inputs
+        batch_size (integer): mini batch size for the 'minibatch' backend
+        max_iter (integer): maximum number of iterations for each fit
+        tol (numeric): convergence tolerance relative to the mean variance of the events
+        random_state (integer): seed for the 'minibatch' backend batches
 
-    cluster_list = []
-    ss_intertia_list = []
-    silhouette_list = []
-    ch_score_list = []
-    db_score_list = []
-    for n in range(2, max_clusters):
-        kmeans = KMeans(n_clusters=n)
+    '''
+    
+    import numpy as np
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    
+    events_locations = np.asarray(events_locations, dtype=float)
+    x_squared_norms = (events_locations ** 2).sum(axis=1)
+    
+    centroids = events_locations.mean(axis=0)[np.newaxis, :]
+    cluster_labels = np.zeros(len(events_locations), dtype=int)
+    min_distances = ((events_locations - centroids) ** 2).sum(axis=1)
+    
+    for clusters in range(2, max_clusters):
+        # Split the worst cluster along its principal direction
+        cluster_sse = np.bincount(cluster_labels, weights=min_distances, minlength=len(centroids))
+        worst = cluster_sse.argmax()
+        worst_locations = events_locations[cluster_labels == worst]
+        if len(worst_locations) > 1:
+            eigenvalues, eigenvectors = np.linalg.eigh(np.cov(worst_locations.T))
+            offset = np.sqrt(max(eigenvalues[-1], 0)) * eigenvectors[:, -1]
+        else:
+            offset = np.zeros(events_locations.shape[1])
+        centroids = np.vstack([centroids, centroids[worst] - offset])
+        centroids[worst] = centroids[worst] + offset
+        
+        with stage('K-Means Fit', rows=len(events_locations), clusters=clusters, backend=backend):
+            if backend == 'lloyd':
+                kmeans = KMeans(n_clusters=clusters, init=centroids, n_init=1, max_iter=max_iter, tol=tol)
+            elif backend == 'minibatch':
+                kmeans = MiniBatchKMeans(n_clusters=clusters, init=centroids, n_init=1, batch_size=batch_size,
+                                         max_iter=max_iter, tol=tol, random_state=random_state)
+            else:
+                raise ValueError("backend must be 'lloyd' or 'minibatch'")
+            kmeans.fit(events_locations)
+            centroids, cluster_labels, inertia = kmeans.cluster_centers_, kmeans.labels_, kmeans.inertia_
+        
+        min_distances = np.maximum(x_squared_norms - 2 * (events_locations * centroids[cluster_labels]).sum(axis=1)
+                                   + (centroids[cluster_labels] ** 2).sum(axis=1), 0)
+        
+        yield clusters, cluster_labels, centroids, inertia
+
+
+def cluster_sum_of_squares(events_locations, cluster_labels):
+    
+    '''
+    Calculates the sum of squared distances of events to their cluster centroid, the k-means inertia for any cluster labels.
+    
+    Parameter:
+        events_locations (array): event start and end vertical locations
+        cluster_labels (list): list of assigned cluster labels
+
+    '''
+    
+    import numpy as np
+    
+    _, cluster_index = np.unique(cluster_labels, return_inverse=True)
+    counts = np.bincount(cluster_index)
+    centroids = np.column_stack([np.bincount(cluster_index, weights=events_locations[:, d]) / counts
+                                 for d in range(events_locations.shape[1])])
+    
+    return ((events_locations - centroids[cluster_index]) ** 2).sum()
+
+
+def cluster_label_scores(events_locations, cluster_labels, clusters, inertia, random_state=None, silhouette_method='full', silhouette_sample_size=10000, memory_cap_mb=256):
+    
+    '''
+    Calculates the cluster evaluation measures for a set of cluster labels.
+    
+    Parameter:
+        events_locations (array): event start and end vertical locations
+        cluster_labels (list): list of assigned cluster labels
+        clusters (integer): number of clusters
+        inertia (numeric): sum of squared distances of events to their cluster centroid
+        random_state (integer): seed for silhouette sampling
+        silhouette_method (string): specify 'full', 'chunked' or 'sampled', see silhouette_evaluation()
+        silhouette_sample_size (integer): number of events to score for the sampled silhouette
+        memory_cap_mb (numeric): memory limit in megabytes for each chunk of the distance matrix
+
+    '''
+    
+    from sklearn import metrics
+    
+    with stage('Calinski-Harabasz Index', rows=len(events_locations), clusters=clusters):
+        calinski_harabasz = metrics.calinski_harabasz_score(events_locations, cluster_labels)
+    with stage('Davies-Bouldin Index', rows=len(events_locations), clusters=clusters):
+        davies_bouldin = metrics.davies_bouldin_score(events_locations, cluster_labels)
+    with stage('Silhouette Coefficient', rows=len(events_locations), clusters=clusters, method=silhouette_method):
+        silhouette_dict = silhouette_evaluation(events_locations, cluster_labels, method=silhouette_method,
+                                                sample_size=silhouette_sample_size, memory_cap_mb=memory_cap_mb,
+                                                random_state=random_state)
+    
+    scores = {'Clusters': clusters,
+              'Sum of Squares': inertia,
+              'Calinski-Harabasz Index': calinski_harabasz,
+              'Davies-Bouldin Index': davies_bouldin}
+    scores.update(silhouette_dict)
+    
+    return scores
+
+
+def kmeans_evaluation_scores(events_locations, clusters, random_state=None, silhouette_method='full', silhouette_sample_size=10000, memory_cap_mb=256):
+    
+    '''
+    Applies k-means clustering with a given number of clusters and returns the cluster evaluation measures.
+    Kept at module level so it can be sent to worker processes.
+    
+    Parameter:
+        events_locations (array): event start and end vertical locations
+        clusters (integer): number of clusters to use for k-means
+        random_state (integer): seed for k-means centroid initialisation and silhouette sampling
+        silhouette_method (string): specify 'full', 'chunked' or 'sampled', see silhouette_evaluation()
+        silhouette_sample_size (integer): number of events to score for the sampled silhouette
+        memory_cap_mb (numeric): memory limit in megabytes for each chunk of the distance matrix
+
+    '''
+    
+    from sklearn.cluster import KMeans
+    
+    with stage('K-Means Fit', rows=len(events_locations), clusters=clusters):
+        kmeans = KMeans(n_clusters=clusters, random_state=random_state)
         kmeans.fit(events_locations)
         cluster_labels = kmeans.predict(events_locations)
+    
+    scores = cluster_label_scores(events_locations, cluster_labels, clusters, kmeans.inertia_, random_state=random_state,
+                                  silhouette_method=silhouette_method, silhouette_sample_size=silhouette_sample_size,
+                                  memory_cap_mb=memory_cap_mb)
+    
+    return scores
 
-        cluster_list.append(n)
-
-        ss_intertia = kmeans.inertia_
-        ss_intertia_list.append(ss_intertia)
 
-        silhouette = metrics.silhouette_score(events_locations, cluster_labels, metric='euclidean')
-        silhouette_list.append(silhouette)
+@instrumented
+def cluster_evaluation(events_df, max_clusters=None, n_jobs=1, random_state=None, silhouette_method='full', silhouette_sample_size=10000, memory_cap_mb=256, sweep='independent', kmeans_backend='lloyd', batch_size=1024, method='kmeans', min_distance=10, max_distance=500, distance_step=10, linkage='ward', linkage_matrix=None):
+    
+    '''
+    Applies k-means clustering to events start and end vertical locations using all numbers of clusters up to max_clusters,
+    or agglomerative clustering using all distance thresholds from min_distance up to max_distance.
+    Cluster evaluation measures are calculated and stored in dataframe.
+    The agglomerative tree is built once and cut at each distance threshold, thresholds giving the same clusters share scores.
+    Each number of clusters is fitted with its own seed drawn from random_state, so the result does not depend on n_jobs.
+    The incremental sweep warm starts each number of clusters from the previous fit instead, see incremental_kmeans_sweep().
+    
+    Parameter:
+        events_df (dataframe): event dataframe with x and y vertical locations
+        max_clusters (integer): maximum number of clusters to evaluate for k-means, required for method='kmeans'
+        n_jobs (integer): number of worker processes, 1 to run in this process, -1 to use all cores
+        random_state (integer): seed for k-means centroid initialisation and silhouette sampling, None for unseeded
+        silhouette_method (string): specify 'full', 'chunked' or 'sampled', 'chunked' and 'sampled' keep memory bounded on large event sets
+        silhouette_sample_size (integer): number of events to score for the sampled silhouette
+        memory_cap_mb (numeric): memory limit in megabytes for each chunk of the distance matrix
+        sweep (string): specify 'independent' to fit each number of clusters from scratch or 'incremental' to warm start
+        kmeans_backend (string): specify 'lloyd' or 'minibatch' for the incremental sweep
+        batch_size (integer): mini batch size for the 'minibatch' backend
+        method (string): specify 'kmeans' or 'agglomerative'
+        min_distance (numeric): smallest agglomerative distance threshold
+        max_distance (numeric): largest agglomerative distance threshold, exclusive
+        distance_step (numeric): step between agglomerative distance thresholds
+        linkage (string): agglomerative linkage criterion, 'ward', 'complete', 'average' or 'single'
+        linkage_matrix (array): tree from agglomerative_linkage() to reuse, None to build it
 
-        ch_score = metrics.calinski_harabasz_score(events_locations, cluster_labels)
-        ch_score_list.append(ch_score)
+    '''
+    
+    import os
+    import numpy as np
+    import pandas as pd
+    from itertools import repeat
+    from functools import partial
+    from concurrent.futures import ProcessPoolExecutor
+    
+    from scipy.cluster import hierarchy
+    
+    events_locations = events_df[['vertical_location_x', 'vertical_location_y', 'vertical_end_location_x', 'vertical_end_location_y']].to_numpy()
+    columns = ['Clusters', 'Sum of Squares', 'Silhouette Coefficient', 'Calinski-Harabasz Index', 'Davies-Bouldin Index',
+               'Silhouette Lower', 'Silhouette Upper', 'Silhouette Method', 'Silhouette Sample Size']
 
-        db_score = metrics.davies_bouldin_score(events_locations, cluster_labels)
-        db_score_list.append(db_score)
+    if method == 'agglomerative':
+        cluster_list = list(np.arange(min_distance, max_distance, distance_step))
+    elif method == 'kmeans':
+        if max_clusters is None:
+            raise ValueError("max_clusters is required for method='kmeans'")
+        cluster_list = list(range(2, max_clusters))
+    else:
+        raise ValueError("method must be 'kmeans' or 'agglomerative'")
+    
+    if random_state is None:
+        seed_list = [None] * len(cluster_list)
+    else:
+        seed_list = [int(seed) for seed in np.random.SeedSequence(random_state).generate_state(len(cluster_list))]
+    
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    
+    if method == 'agglomerative':
+        label_scores = partial(cluster_label_scores, silhouette_method=silhouette_method,
+                               silhouette_sample_size=silhouette_sample_size, memory_cap_mb=memory_cap_mb)
+        if linkage_matrix is None:
+            linkage_matrix = agglomerative_linkage(events_df, linkage)
+        
+        # Thresholds between the same two merge heights give the same clusters, so score each number of clusters once
+        label_dict = {}
+        threshold_clusters = []
+        with stage('Tree Cuts', rows=len(events_locations), thresholds=len(cluster_list)):
+            for distance_threshold, seed in zip(cluster_list, seed_list):
+                cluster_labels = hierarchy.fcluster(linkage_matrix, distance_threshold, criterion='distance') - 1
+                clusters = cluster_labels.max() + 1
+                threshold_clusters.append(clusters)
+                if clusters not in label_dict and 1 < clusters < len(events_locations):
+                    label_dict[clusters] = (cluster_labels, seed)
+        
+        if n_jobs == 1:
+            scores_list = [label_scores(events_locations, cluster_labels, clusters,
+                                        cluster_sum_of_squares(events_locations, cluster_labels), random_state=seed)
+                           for clusters, (cluster_labels, seed) in label_dict.items()]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(worker_function(label_scores), events_locations, cluster_labels, clusters,
+                                           cluster_sum_of_squares(events_locations, cluster_labels), random_state=seed)
+                           for clusters, (cluster_labels, seed) in label_dict.items()]
+                scores_list = [worker_output(future.result()) for future in futures]
+        scores_dict = {scores['Clusters']: scores for scores in scores_list}
+        
+        cluster_evaluation_df = pd.DataFrame([scores_dict.get(clusters, {'Clusters': clusters}) for clusters in threshold_clusters],
+                                             columns=columns)
+        cluster_evaluation_df.insert(0, 'Distance Threshold', cluster_list)
+        
+        return cluster_evaluation_df
+    
+    if sweep == 'incremental':
+        label_scores = partial(cluster_label_scores, silhouette_method=silhouette_method,
+                               silhouette_sample_size=silhouette_sample_size, memory_cap_mb=memory_cap_mb)
+        kmeans_sweep = incremental_kmeans_sweep(events_locations, max_clusters, backend=kmeans_backend,
+                                                batch_size=batch_size, random_state=random_state)
+        
+        if n_jobs == 1:
+            scores_list = [label_scores(events_locations, cluster_labels, clusters, inertia, random_state=seed)
+                           for (clusters, cluster_labels, centroids, inertia), seed in zip(kmeans_sweep, seed_list)]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(worker_function(label_scores), events_locations, cluster_labels, clusters, inertia, random_state=seed)
+                           for (clusters, cluster_labels, centroids, inertia), seed in zip(kmeans_sweep, seed_list)]
+                scores_list = [worker_output(future.result()) for future in futures]
+    else:
+        evaluation_scores = partial(kmeans_evaluation_scores, silhouette_method=silhouette_method,
+                                    silhouette_sample_size=silhouette_sample_size, memory_cap_mb=memory_cap_mb)
+        
+        if n_jobs == 1:
+            scores_list = list(map(evaluation_scores, repeat(events_locations), cluster_list, seed_list))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                scores_list = [worker_output(scores) for scores in
+                               executor.map(worker_function(evaluation_scores), repeat(events_locations), cluster_list, seed_list)]
 
-    cluster_evaluation_dict = {'Clusters': cluster_list,
-                               'Sum of Squares' : ss_intertia_list,
-                               'Silhouette Coefficient' : silhouette_list,
-                               'Calinski-Harabasz Index' : ch_score_list,
-                               'Davies-Bouldin Index' : db_score_list}
-    cluster_evaluation_df = pd.DataFrame(cluster_evaluation_dict)
+    cluster_evaluation_df = pd.DataFrame(scores_list, columns=columns)
     
     return cluster_evaluation_df
 
 
-def plot_cluster_evaluation(cluster_evaluation_df):
+def plot_cluster_evaluation(cluster_evaluation_df, method='kmeans'):
     
     '''
     Plot cluster evaluation metrics in a 2x2 grid.
     
     Parameters:
         cluster_evaluation_df (dataframe): dataframe of cluster evaluation metrics from cluster_evaluation()
+        method (string): specify 'kmeans' to plot against clusters or 'agglomerative' to plot against distance threshold
 
     ''' 
     
     import matplotlib.pyplot as plt
     
+    if method == 'agglomerative':
+        x_column = 'Distance Threshold'
+    else:
+        x_column = 'Clusters'
+    
     fig, axs = plt.subplots(2, 2, figsize = (8, 8))
-    axs[0,0].plot(cluster_evaluation_df['Clusters'], cluster_evaluation_df['Sum of Squares'])
+    axs[0,0].plot(cluster_evaluation_df[x_column], cluster_evaluation_df['Sum of Squares'])
     axs[0,0].set_title("Sum of Squares within Cluster")
-    axs[0,1].plot(cluster_evaluation_df['Clusters'], cluster_evaluation_df['Silhouette Coefficient'])
+    axs[0,1].plot(cluster_evaluation_df[x_column], cluster_evaluation_df['Silhouette Coefficient'])
     axs[0,1].set_title("Silhouette Coefficient")
-    axs[1,0].plot(cluster_evaluation_df['Clusters'], cluster_evaluation_df['Calinski-Harabasz Index'])
+    axs[1,0].plot(cluster_evaluation_df[x_column], cluster_evaluation_df['Calinski-Harabasz Index'])
     axs[1,0].set_title("Calinski-Harabasz Index")
-    axs[1,1].plot(cluster_evaluation_df['Clusters'], cluster_evaluation_df['Davies-Bouldin Index'])
+    axs[1,1].plot(cluster_evaluation_df[x_column], cluster_evaluation_df['Davies-Bouldin Index'])
     axs[1,1].set_title("Davies-Bouldin Index")
 
     for ax in axs.flat:
-        ax.set(xlabel='Clusters')
+        ax.set(xlabel=x_column)
         ax.label_outer() 
 
     return fig, axs
\ No newline at end of file
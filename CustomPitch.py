@@ -1,6 +1,66 @@
-import matplotlib.pyplot as plt
-from matplotlib.patches import Arc
+from functools import lru_cache
+from Instrumentation import instrumented
 
+@lru_cache(maxsize=None)
+def pitchTemplate(length=120, width=80):
+
+    '''
+    Creates and caches the markings of a vertical football pitch, so repeated pitches skip the geometry.
+    Artists cannot be shared between axes, so the template holds the line segments and patch settings instead.
+    Colours are not part of the template, so any matplotlib colour can still be passed to createVerticalPitch.
+
+    Parameters:
+        length (integer): length of pitch in yards
+        width (integer): width of pitch in yards
+
+    '''
+
+    import numpy as np
+
+    segments = np.array([
+        #Pitch Outline & Centre Line
+        [[0, 0], [width, 0]],
+        [[0, 0], [0, length]],
+        [[0, length], [width, length]],
+        [[width, 0], [width, length]],
+        [[0, length/2], [width, length/2]],
+
+        #Bottom Penalty Area
+        [[width/2+22, 18], [width/2-22, 18]],
+        [[width/2+22, 0], [width/2+22, 18]],
+        [[width/2-22, 18], [width/2-22, 0]],
+
+        #Top Penalty Area
+        [[width/2+22, length-18], [width/2+22, length]],
+        [[width/2+22, length-18], [width/2-22, length-18]],
+        [[width/2-22, length-18], [width/2-22, length]],
+
+        #Bottom 6-yard Box
+        [[width/2+7.32/2+6, 0], [width/2+7.32/2+6, 6]],
+        [[width/2+7.32/2+6, 6], [width/2-7.32/2-6, 6]],
+        [[width/2-7.32/2-6, 6], [width/2-7.32/2-6, 0]],
+
+        #Top 6-yard Box
+        [[width/2+7.32/2+6, length], [width/2+7.32/2+6, length-6]],
+        [[width/2+7.32/2+6, length-6], [width/2-7.32/2-6, length-6]],
+        [[width/2-7.32/2-6, length-6], [width/2-7.32/2-6, length]]
+    ])
+    segments.setflags(write=False)
+
+    #Circles; 10 yards distance. penalty on 12 yards. (centre, radius, fill)
+    circles = (((width/2, length/2), 10, False),
+               ((width/2, length/2), 0.8, True),
+               ((width/2, 12), 0.8, True),
+               ((width/2, length-12), 0.8, True))
+
+    #Arcs; (centre, theta1, theta2)
+    arcs = (((width/2, 11), 48, 132),
+            ((width/2, length-11), 228, 312))
+
+    return segments, circles, arcs
+
+
+@instrumented
 def createVerticalPitch(length=120, width=80, metric='yards', pitch_theme = 'light', linecolor='black', ax_colour = 'white', figsize = (5, 10), figax = None):
 
     '''
@@ -18,7 +78,10 @@ def createVerticalPitch(length=120, width=80, metric='yards', pitch_theme = 'lig
         
     '''
     
-    
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Arc
+    from matplotlib.collections import LineCollection
+
     if figax == None:
         #print("figax == None")
         fig = plt.figure(figsize = figsize)
@@ -35,65 +98,31 @@ def createVerticalPitch(length=120, width=80, metric='yards', pitch_theme = 'lig
     elif pitch_theme == 'dark':
         linecolor = 'white'
         ax_colour = '#303030'
-    
+
+    segments, circles, arcs = pitchTemplate(length, width)
+
     ax.set_facecolor(ax_colour)
-    
-    #Pitch Outline & Centre Line
-    ax.plot([0,width],[0,0], color=linecolor)
-    ax.plot([0,0],[0,length], color=linecolor)
-    ax.plot([0, width],[length, length], color=linecolor)
-    ax.plot([width, width],[0, length], color=linecolor)
-    ax.plot([0,width], [length/2,length/2], color=linecolor)
-
-    #Bottom Penalty Area
-    ax.plot([(width/2 +22),(width/2-22)],[18 ,18],color=linecolor)
-    ax.plot([(width/2 +22),(width/2 +22)], [0,18],color=linecolor)
-    ax.plot([(width/2 -22),(width/2 -22)],[18,0],color=linecolor)
-
-    #Top Penalty Area
-    ax.plot([(width/2 +22),(width/2 +22)],[(length-18),length],color=linecolor)
-    ax.plot([(width/2 +22),(width/2-22)],[(length-18), (length-18)],color=linecolor)
-    ax.plot([(width/2 -22),(width/2 -22)],[(length-18),length],color=linecolor)
-
-    #Bottom 6-yard Box
-    ax.plot([(width/2+7.32/2+6),(width/2+7.32/2+6)],[0,6],color=linecolor)
-    ax.plot([(width/2+7.32/2+6),(width/2-7.32/2-6)],[6,6],color=linecolor)
-    ax.plot([(width/2-7.32/2-6),(width/2-7.32/2-6)],[6,0],color=linecolor)
-
-    #Top 6-yard Box
-    ax.plot([(width/2+7.32/2+6),(width/2+7.32/2+6)],[length,length-6],color=linecolor)
-    ax.plot([(width/2+7.32/2+6),width/2-7.32/2-6],[length-6,length-6],color=linecolor)
-    ax.plot([(width/2-7.32/2-6),width/2-7.32/2-6],[length-6,length],color=linecolor)
-
-    #Prepare Circles; 10 yards distance. penalty on 12 yards
-    centreCircle = plt.Circle((width/2,length/2),10,color=linecolor,fill=False)
-    centreSpot = plt.Circle((width/2,length/2),0.8,color=linecolor)
-    bottomPenSpot = plt.Circle((width/2,12),0.8,color=linecolor)
-    topPenSpot = plt.Circle((width/2,length-12),0.8,color=linecolor)
 
-    #Draw Circles
-    ax.add_patch(centreCircle)
-    ax.add_patch(centreSpot)
-    ax.add_patch(bottomPenSpot)
-    ax.add_patch(topPenSpot)
+    #Pitch lines in a single collection
+    ax.add_collection(LineCollection(segments, colors=linecolor, capstyle='projecting', zorder=2))
 
-    #Prepare Arcs
-    bottomArc = Arc((width/2,11),height=20,width=20,angle=0,theta1=48,theta2=132,color=linecolor)
-    topArc = Arc((width/2,length-11,),height=20,width=20,angle=0,theta1=228,theta2=312,color=linecolor)
+    #Draw Circles
+    for centre, radius, fill in circles:
+        ax.add_patch(plt.Circle(centre, radius, color=linecolor, fill=fill))
 
     #Draw Arcs
-    ax.add_patch(bottomArc)
-    ax.add_patch(topArc)
+    for centre, theta1, theta2 in arcs:
+        ax.add_patch(Arc(centre, height=20, width=20, angle=0, theta1=theta1, theta2=theta2, color=linecolor))
 
     #Tidy Axes
     #ax.axis('off')
-    plt.xticks([])
-    plt.yticks([])
+    ax.set_xticks([])
+    ax.set_yticks([])
     ax.spines["top"].set_visible(False)
     ax.spines["right"].set_visible(False)
     ax.spines["bottom"].set_visible(False)
     ax.spines["left"].set_visible(False)
-    
+
     ax.set_aspect('equal')
-    
-    return fig,ax
\ No newline at end of file
+
+    return fig,ax
@@ -0,0 +1,265 @@
+import os
+import time
+from functools import wraps, partial
+from contextlib import contextmanager, nullcontext
+
+# Module level state, instrumentation is off until enable_instrumentation() is called
+_instrumentation = {'enabled': False, 'trace_memory': False, 'started_tracing': False, 'records': [], 'stack': []}
+
+# Returned by stage() when disabled, values written to its record are discarded
+_disabled_stage = nullcontext({})
+
+
+def enable_instrumentation(trace_memory=False):
+
+    '''
+    Turns on stage recording across StatsBombPrep, ClusterEval, StatsBombViz and CustomPitch.
+    Stages record wall time, rows, artists drawn and, if trace_memory, peak traced allocations.
+
+    Parameters:
+        trace_memory (boolean): record peak allocations of each stage with tracemalloc, this slows Python code down
+
+    '''
+
+    import tracemalloc
+
+    _instrumentation['enabled'] = True
+    _instrumentation['trace_memory'] = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _instrumentation['started_tracing'] = True
+
+
+def disable_instrumentation():
+
+    '''
+    Turns off stage recording, recorded stages are kept until clear_instrumentation() is called.
+    '''
+
+    import tracemalloc
+
+    if _instrumentation['started_tracing']:
+        tracemalloc.stop()
+        _instrumentation['started_tracing'] = False
+    _instrumentation['enabled'] = False
+    _instrumentation['trace_memory'] = False
+
+
+def instrumentation_enabled():
+
+    '''
+    Returns whether stages are being recorded.
+    '''
+
+    return _instrumentation['enabled']
+
+
+def clear_instrumentation():
+
+    '''
+    Removes all recorded stages.
+    '''
+
+    _instrumentation['records'] = []
+
+
+def count_artists(figure_or_ax):
+
+    '''
+    Counts the artists on a figure's axes or a single axes, including lines, patches, collections and text.
+
+    Parameters:
+        figure_or_ax (figure or axes): figure or axes to count artists on
+
+    '''
+
+    axes_list = figure_or_ax.axes if isinstance(figure_or_ax.axes, list) else [figure_or_ax]
+
+    return sum(len(ax.get_children()) for ax in axes_list)
+
+
+@contextmanager
+def _recorded_stage(name, rows, ax, fields):
+
+    import tracemalloc
+
+    stack = _instrumentation['stack']
+    trace_memory = _instrumentation['trace_memory'] and tracemalloc.is_tracing()
+
+    record = {'Stage': name, 'Parent': stack[-1]['Stage'] if stack else None, 'Depth': len(stack),
+              'Start': time.perf_counter(), 'Seconds': None, 'Rows': rows, 'Artists': None, 'Peak MB': None,
+              'Process': os.getpid()}
+    record.update({field.replace('_', ' ').title(): value for field, value in fields.items()})
+
+    artists_start = count_artists(ax) if ax is not None else None
+    if trace_memory:
+        # The peak is reset for each stage, so hand the peak so far to the enclosing stage first
+        memory_start, memory_peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['_peak'] = max(stack[-1]['_peak'], memory_peak)
+        tracemalloc.reset_peak()
+        record['_peak'] = memory_start
+
+    stack.append(record)
+    try:
+        yield record
+    finally:
+        stack.pop()
+        record['Seconds'] = time.perf_counter() - record['Start']
+        if ax is not None and record['Artists'] is None:
+            record['Artists'] = count_artists(ax) - artists_start
+        peak = record.pop('_peak', None)
+        if trace_memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            record['Peak MB'] = (peak - memory_start) / 2 ** 20
+            if stack:
+                stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+            tracemalloc.reset_peak()
+        _instrumentation['records'].append(record)
+
+
+def stage(name, rows=None, ax=None, **fields):
+
+    '''
+    Context manager recording one stage of work, e.g. with stage('K-Means Fit', rows=len(events), clusters=k): ...
+    Yields the record dict so values known later, such as rows or artists, can be filled in.
+    When instrumentation is disabled nothing is recorded and the cost is one function call.
+
+    Parameters:
+        name (string): name of the stage
+        rows (integer): number of rows or events processed
+        ax (figure or axes): count the artists added to this figure or axes during the stage
+        fields: extra values to record, e.g. clusters=4, stored with title case names
+
+    '''
+
+    if not _instrumentation['enabled']:
+        return _disabled_stage
+
+    return _recorded_stage(name, rows, ax, fields)
+
+
+def instrumented(function):
+
+    '''
+    Decorator recording each call of a function as a stage named after it.
+    Rows are the length of the first argument, and artists are counted when the function returns a figure first.
+
+    Parameters:
+        function (function): function to record
+
+    '''
+
+    @wraps(function)
+    def instrumented_function(*args, **kwargs):
+        if not _instrumentation['enabled']:
+            return function(*args, **kwargs)
+
+        rows = len(args[0]) if args and hasattr(args[0], '__len__') and not isinstance(args[0], str) else None
+        with stage(function.__name__, rows=rows) as record:
+            output = function(*args, **kwargs)
+            if isinstance(output, tuple) and output and hasattr(output[0], 'get_axes'):
+                record['Artists'] = count_artists(output[0])
+        return output
+
+    return instrumented_function
+
+
+def _instrumented_call(function, trace_memory, *args, **kwargs):
+
+    # Forked workers start with a copy of the parent's stages, so begin from empty
+    enable_instrumentation(trace_memory)
+    clear_instrumentation()
+    _instrumentation['stack'] = []
+    try:
+        output = function(*args, **kwargs)
+    finally:
+        records = _instrumentation['records']
+        disable_instrumentation()
+        clear_instrumentation()
+
+    return output, records
+
+
+def worker_function(function):
+
+    '''
+    Wraps a function sent to worker processes so the stages it records are returned with its output.
+    Returns the function unchanged when instrumentation is disabled. Pass each output through worker_output().
+
+    Parameters:
+        function (function): module level function to run in a worker process
+
+    '''
+
+    if not _instrumentation['enabled']:
+        return function
+
+    return partial(_instrumented_call, function, _instrumentation['trace_memory'])
+
+
+def worker_output(output):
+
+    '''
+    Unwraps the output of a function wrapped by worker_function(), adding its stages under the current stage.
+
+    Parameters:
+        output: output returned from the worker process
+
+    '''
+
+    if not _instrumentation['enabled']:
+        return output
+
+    output, records = output
+    stack = _instrumentation['stack']
+    for record in records:
+        if record['Depth'] == 0 and stack:
+            record['Parent'] = stack[-1]['Stage']
+        record['Depth'] += len(stack)
+    _instrumentation['records'].extend(records)
+
+    return output
+
+
+def instrumentation_records():
+
+    '''
+    Returns the recorded stages as a dataframe, one row per stage in the order they finished.
+    Start is in seconds from the first recorded stage.
+    '''
+
+    import pandas as pd
+
+    records_df = pd.DataFrame(_instrumentation['records'])
+    if len(records_df):
+        records_df['Start'] = records_df['Start'] - records_df['Start'].min()
+
+    return records_df
+
+
+def write_trace(path):
+
+    '''
+    Writes the recorded stages to a Chrome trace event json file, which can be opened in Perfetto or chrome://tracing.
+
+    Parameters:
+        path (string): file path to write to
+
+    '''
+
+    import json
+
+    records = _instrumentation['records']
+    start = min([record['Start'] for record in records], default=0)
+
+    trace_events = []
+    for record in records:
+        args = {key: value for key, value in record.items()
+                if key not in ('Stage', 'Start', 'Seconds', 'Process', 'Depth', 'Parent') and value is not None}
+        trace_events.append({'name': record['Stage'], 'cat': 'stage', 'ph': 'X',
+                             'ts': (record['Start'] - start) * 1e6, 'dur': record['Seconds'] * 1e6,
+                             'pid': record['Process'], 'tid': record['Process'], 'args': args})
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events}, f, default=str)
@@ -1,3 +1,7 @@
+from Instrumentation import instrumented, stage
+
+
+@instrumented
 def ball_progression_events_into_thirds(events, x_min=0, y_min=0, x_max=80, y_max=120, x_pen_area=44, y_pen_area=18):
 
     '''
@@ -30,4 +34,387 @@ def ball_progression_events_into_thirds(events, x_min=0, y_min=0, x_max=80, y_ma
                            (events['vertical_end_location_x'] > x_left_pen_area) & 
                            (events['vertical_end_location_x'] < x_right_pen_area)]
     
-    return from_own_third, from_mid_third, from_final_third, into_pen_area
\ No newline at end of file
+    return from_own_third, from_mid_third, from_final_third, into_pen_area
+
+
+@instrumented
+def ball_progression_zones(events, x_min=0, y_min=0, x_max=80, y_max=120, x_pen_area=44, y_pen_area=18,
+                           y_edges=None, y_labels=('final_third', 'mid_third', 'own_third'), x_edges=None, x_labels=None,
+                           min_progression=10):
+
+    '''
+    Labels ball progressions by the zone they start from in a single pass over the vertical locations.
+    Play is towards y_min. Zones are bands between y_edges, optionally split into channels between x_edges.
+    An event progresses from a band when it ends beyond the band's forward edge and moves more than min_progression,
+    or for the most forward band when it ends further forward than it started. Events on a y edge belong to no band.
+    Into the penalty area is labelled separately as it can overlap any zone.
+    
+    Returns a dataframe with a categorical 'zone' column and a boolean 'into_pen_area' column aligned to events,
+    and a dictionary of zone name to row positions, so each zone is events.iloc[zone_index[zone]] without boolean masks.
+    
+    Parameters:
+        events (dataframe): event dataframe with x and y vertical locations 
+        x_min (integer): minimum x location
+        y_min (integer): minimum y location
+        x_max (integer): maximum x location
+        y_max (integer): maximum y location
+        x_pen_area (integer): penalty area x distance
+        y_pen_area (integer): penalty area y distance
+        y_edges (list): ascending y boundaries between bands, None for thirds
+        y_labels (list): band names from y_min, one more than y_edges
+        x_edges (list): ascending x boundaries between channels, None for no channels
+        x_labels (list): channel names from x_min, one more than x_edges, None for channel_0, channel_1, ...
+        min_progression (numeric): minimum y distance for a progression from any band but the most forward
+
+    '''
+    
+    import numpy as np
+    import pandas as pd
+    
+    if y_edges is None:
+        y_edges = [y_max / 3, y_max - y_max / 3]
+    y_edges = np.asarray(y_edges, dtype=float)
+    if x_edges is None:
+        x_edges, x_labels = np.array([]), ['']
+    elif x_labels is None:
+        x_labels = ['channel_%d' % i for i in range(len(x_edges) + 1)]
+    x_edges = np.asarray(x_edges, dtype=float)
+    if len(y_labels) != len(y_edges) + 1:
+        raise ValueError('y_labels must have one more label than y_edges')
+    if len(x_labels) != len(x_edges) + 1:
+        raise ValueError('x_labels must have one more label than x_edges')
+    
+    x_start = events['vertical_location_x'].to_numpy(dtype=float)
+    y_start = events['vertical_location_y'].to_numpy(dtype=float)
+    x_end = events['vertical_end_location_x'].to_numpy(dtype=float)
+    y_end = events['vertical_end_location_y'].to_numpy(dtype=float)
+    
+    # A few edges, so counting edges passed is cheaper than a binary search, missing locations fall in band 0 and fail below
+    y_band = np.zeros(len(events), dtype=np.int16)
+    for y_edge in y_edges:
+        y_band += y_start >= y_edge
+    x_channel = np.zeros(len(events), dtype=np.int16)
+    for x_edge in x_edges:
+        x_channel += x_start >= x_edge
+    
+    # Forward edge of each band, the most forward band only needs to move forward
+    forward_edge = np.concatenate([[np.nan], y_edges])[y_band]
+    with np.errstate(invalid='ignore'):
+        progression = np.where(y_band == 0, y_end < y_start,
+                               (y_end < forward_edge) & (y_start - y_end > min_progression))
+    progression &= ~np.isin(y_start, y_edges)
+    
+    # Small integer codes so the stable sort below is a radix sort
+    zone_codes = np.where(progression, y_band * len(x_labels) + x_channel, -1).astype(np.int16)
+    zone_names = ['_'.join(['from', y_label, x_label]).rstrip('_') for y_label in y_labels for x_label in x_labels]
+    
+    x_right_pen_area = x_max - ((x_max - x_pen_area) / 2)
+    x_left_pen_area = x_min + ((x_max - x_pen_area) / 2)
+    with np.errstate(invalid='ignore'):
+        into_pen_area = (y_end < y_min + y_pen_area) & (x_end > x_left_pen_area) & (x_end < x_right_pen_area)
+    
+    zone_df = pd.DataFrame({'zone': pd.Categorical.from_codes(zone_codes, zone_names),
+                            'into_pen_area': into_pen_area}, index=events.index)
+    
+    # One stable sort groups the row positions of every zone, keeping event order within each zone
+    zone_order = np.argsort(zone_codes, kind='stable')
+    zone_counts = np.bincount(zone_codes[progression], minlength=len(zone_names))
+    zone_starts = len(zone_codes) - progression.sum() + np.cumsum(zone_counts) - zone_counts
+    zone_index = {zone_name: zone_order[start:start + count] for zone_name, start, count in zip(zone_names, zone_starts, zone_counts)}
+    zone_index['into_pen_area'] = np.flatnonzero(into_pen_area)
+    
+    return zone_df, zone_index
+
+
+def load_match_events(events_path, match_id):
+
+    '''
+    Loads one StatsBomb open-data events file into a flat dataframe.
+    Kept at module level so it can be sent to worker processes.
+    
+    Parameters:
+        events_path (string): path to the open-data events folder
+        match_id (integer): match id of the events file to load
+
+    '''
+    
+    import os
+    import json
+    import pandas as pd
+    
+    with open(os.path.join(events_path, str(match_id) + '.json'), encoding='utf-8') as f:
+        events = json.load(f)
+    events_df = pd.json_normalize(events, sep='_')
+    events_df['match_id'] = match_id
+    
+    return events_df
+
+
+@instrumented
+def load_season_events(data_path, competition_id, season_id, cache_path=None, cache_format='feather', n_jobs=1,
+                       categorical_columns=('type_name', 'team_name', 'possession_team_name', 'play_pattern_name')):
+
+    '''
+    Loads all StatsBomb open-data events for a competition season into one dataframe, with match teams and scores.
+    Matches are parsed in parallel and concatenated once, name columns are stored as categoricals.
+    The result is cached to a Feather or Parquet file keyed on the size and modified time of every source file,
+    so later loads are a memory-mapped read until the source data changes.
+    
+    Parameters:
+        data_path (string): path to the open-data data folder, containing matches and events folders
+        competition_id (integer): StatsBomb competition id, e.g. 2 for Premier League
+        season_id (integer): StatsBomb season id, e.g. 44 for 2003/2004
+        cache_path (string): folder for cached files, None to not cache
+        cache_format (string): specify 'feather' or 'parquet' for cached files
+        n_jobs (integer): number of worker processes for parsing matches, -1 to use all cores
+        categorical_columns (tuple): columns to store as categoricals
+
+    '''
+    
+    import os
+    import glob
+    import json
+    import hashlib
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+    
+    if cache_format not in ('feather', 'parquet'):
+        raise ValueError("cache_format must be 'feather' or 'parquet'")
+    
+    matches_file = os.path.join(data_path, 'matches', str(competition_id), str(season_id) + '.json')
+    events_path = os.path.join(data_path, 'events')
+    
+    with open(matches_file, encoding='utf-8') as f:
+        matches = json.load(f)
+    matches_df = pd.json_normalize(matches, sep='_')
+    match_id_list = matches_df['match_id'].tolist()
+    
+    if cache_path is not None:
+        # Cache key from file stats only, so checking the cache never reads the events
+        source_key = hashlib.sha1()
+        for source_file in [matches_file] + [os.path.join(events_path, str(match_id) + '.json') for match_id in match_id_list]:
+            source_stat = os.stat(source_file)
+            source_key.update('{}|{}|{}'.format(source_file, source_stat.st_size, source_stat.st_mtime_ns).encode())
+        cache_prefix = os.path.join(cache_path, 'events_{}_{}_'.format(competition_id, season_id))
+        cache_file = cache_prefix + source_key.hexdigest()[:16] + '.' + cache_format
+        
+        if os.path.exists(cache_file):
+            with stage('Cache Read', matches=len(match_id_list)) as record:
+                if cache_format == 'feather':
+                    from pyarrow import feather
+                    season_events = feather.read_table(cache_file, memory_map=True).to_pandas()
+                else:
+                    season_events = pd.read_parquet(cache_file)
+                record['Rows'] = len(season_events)
+            return season_events
+    
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    
+    with stage('Parse Matches', matches=len(match_id_list)) as record:
+        if n_jobs == 1:
+            events_list = [load_match_events(events_path, match_id) for match_id in match_id_list]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                events_list = list(executor.map(load_match_events, [events_path] * len(match_id_list), match_id_list))
+        
+        season_events = pd.concat(events_list, ignore_index=True, sort=False)
+        season_events = season_events.merge(matches_df[['match_id', 'away_team_away_team_name', 'away_score',
+                                                        'home_team_home_team_name', 'home_score']],
+                                            on='match_id', how='left')
+        for column in categorical_columns:
+            if column in season_events:
+                season_events[column] = season_events[column].astype('category')
+        record['Rows'] = len(season_events)
+    
+    if cache_path is not None:
+        with stage('Cache Write', rows=len(season_events)):
+            os.makedirs(cache_path, exist_ok=True)
+            for stale_file in glob.glob(cache_prefix + '*.' + cache_format):
+                os.remove(stale_file)
+            if cache_format == 'feather':
+                # Uncompressed so the cached file can be memory mapped
+                season_events.to_feather(cache_file, compression='uncompressed')
+            else:
+                season_events.to_parquet(cache_file)
+    
+    return season_events
+
+
+def list_column_to_xy(column):
+
+    '''
+    Splits a column of [x, y] location lists into contiguous float32 x and y arrays.
+    Missing locations become NaN, any extra values such as shot end heights are ignored.
+    
+    Parameters:
+        column (Series): column of location lists or arrays, with NaN for missing locations
+
+    '''
+    
+    import numpy as np
+    from itertools import chain
+    
+    present = column.notna().to_numpy()
+    locations = column.to_numpy()[present]
+    
+    # One flat pass over all values, then pick the first two of each location by offset
+    lengths = np.fromiter(map(len, locations), dtype=np.int64, count=len(locations))
+    values = np.fromiter(chain.from_iterable(locations), dtype=np.float32, count=lengths.sum())
+    offsets = np.cumsum(lengths) - lengths
+    
+    x = np.full(len(column), np.nan, dtype=np.float32)
+    y = np.full(len(column), np.nan, dtype=np.float32)
+    x[present] = values[offsets]
+    y[present] = values[offsets + 1]
+    
+    return x, y
+
+
+@instrumented
+def split_vertical_locations(events, pitch_width=80, location_columns=('location', 'pass_end_location', 'carry_end_location'), end_location_columns=None):
+
+    '''
+    Adds x, y and vertical x, y columns for each location list column, and the universal end location of each event type.
+    Replaces splitting with apply(pd.Series), all columns are float32 with NaN for missing locations.
+    
+    Parameters:
+        events (dataframe): StatsBomb event dataframe with location list columns
+        pitch_width (integer): width of pitch in yards, used to flip horizontal locations to vertical
+        location_columns (tuple): location list columns to split
+        end_location_columns (dict): event type name to its end location column, default Pass, Carry and Dribble.
+                                     Columns not in events are skipped, leaving NaN end locations for that type
+
+    '''
+    
+    import numpy as np
+    
+    if end_location_columns is None:
+        end_location_columns = {'Pass': 'pass_end_location', 'Carry': 'carry_end_location', 'Dribble': 'dribble_end_location'}
+    
+    end_types = [(type_name, column) for type_name, column in end_location_columns.items() if column in events]
+    split_columns = [column for column in location_columns if column in events]
+    split_columns += [column for type_name, column in end_types if column not in split_columns]
+    
+    location_dict = {}
+    for column in split_columns:
+        x, y = list_column_to_xy(events[column])
+        location_dict[column + '_x'] = x
+        location_dict[column + '_y'] = y
+        location_dict['vertical_' + column + '_x'] = pitch_width - y
+        location_dict['vertical_' + column + '_y'] = x
+    
+    type_names = events['type_name'].to_numpy()
+    conditions = [type_names == type_name for type_name, column in end_types]
+    for prefix in ['', 'vertical_']:
+        for axis in ['_x', '_y']:
+            location_dict[prefix + 'end_location' + axis] = np.select(conditions,
+                                                                      [location_dict[prefix + column + axis] for type_name, column in end_types],
+                                                                      default=np.float32(np.nan)).astype(np.float32)
+    
+    return events.assign(**location_dict)
+
+
+@instrumented
+def event_count_cube(events, group_columns=('match_id', 'team_name', 'type_name'), pitch_length=120, pitch_width=80, x_bins=24, y_bins=36,
+                     x_column='vertical_location_x', y_column='vertical_location_y'):
+
+    '''
+    Bins event locations once into a cube of counts, one pitch grid per group of events.
+    Histograms of any slice of groups are then a sum over the cube, see count_cube_histogram().
+    Returns a dictionary with 'counts' (groups x x_bins x y_bins), 'groups' (dataframe of group keys, one row per group),
+    'xedges' and 'yedges'. Events off the pitch or without a location are not counted.
+    
+    Parameters:
+        events (dataframe): event dataframe with x and y vertical locations
+        group_columns (tuple): columns to slice by later, e.g. match, team, player or event type
+        pitch_length (integer): length of pitch in yards
+        pitch_width (integer): width of pitch in yards
+        x_bins (integer): number of bins across the pitch width
+        y_bins (integer): number of bins along the pitch length
+        x_column (string): column of x locations
+        y_column (string): column of y locations
+
+    '''
+    
+    import numpy as np
+    import pandas as pd
+    
+    group_columns = list(group_columns)
+    group_codes, groups = pd.factorize(pd.MultiIndex.from_frame(events[group_columns].astype(object)))
+    
+    x = events[x_column].to_numpy(dtype=float)
+    y = events[y_column].to_numpy(dtype=float)
+    with np.errstate(invalid='ignore'):
+        on_pitch = (x >= 0) & (x <= pitch_width) & (y >= 0) & (y <= pitch_length) & (group_codes >= 0)
+    
+    # Right hand pitch edges belong to the last bin, as in np.histogram2d
+    x_index = np.minimum((x[on_pitch] * x_bins / pitch_width).astype(np.int64), x_bins - 1)
+    y_index = np.minimum((y[on_pitch] * y_bins / pitch_length).astype(np.int64), y_bins - 1)
+    flat_index = (group_codes[on_pitch] * x_bins + x_index) * y_bins + y_index
+    
+    counts = np.bincount(flat_index, minlength=len(groups) * x_bins * y_bins).reshape(len(groups), x_bins, y_bins)
+    
+    count_cube = {'counts': counts.astype(np.int32),
+                  'groups': groups.to_frame(index=False, name=group_columns),
+                  'xedges': np.linspace(0, pitch_width, x_bins + 1),
+                  'yedges': np.linspace(0, pitch_length, y_bins + 1)}
+    
+    return count_cube
+
+
+def count_cube_histogram(count_cube, group_filter=None):
+
+    '''
+    Sums the count cube over the selected groups, returning (histogram, xedges, yedges) like np.histogram2d.
+    
+    Parameters:
+        count_cube (dictionary): count cube from event_count_cube()
+        group_filter (dictionary or array): column to value or list of values to keep, 
+                                            or a boolean array over count_cube['groups'], None for all groups
+
+    '''
+    
+    import numpy as np
+    
+    groups = count_cube['groups']
+    if group_filter is None:
+        keep = np.ones(len(groups), dtype=bool)
+    elif isinstance(group_filter, dict):
+        keep = np.ones(len(groups), dtype=bool)
+        for column, values in group_filter.items():
+            if np.ndim(values) == 0:
+                values = [values]
+            keep &= groups[column].isin(values).to_numpy()
+    else:
+        keep = np.asarray(group_filter, dtype=bool)
+    
+    histogram = count_cube['counts'][keep].sum(axis=0)
+    
+    return histogram, count_cube['xedges'], count_cube['yedges']
+
+
+def coarsen_count_cube(count_cube, x_factor, y_factor):
+
+    '''
+    Merges blocks of x_factor by y_factor bins of the count cube into single bins, e.g. 24x36 to 6x6 with factors 4 and 6.
+    
+    Parameters:
+        count_cube (dictionary): count cube from event_count_cube()
+        x_factor (integer): number of x bins to merge, must divide the number of x bins
+        y_factor (integer): number of y bins to merge, must divide the number of y bins
+
+    '''
+    
+    n_groups, x_bins, y_bins = count_cube['counts'].shape
+    if x_bins % x_factor or y_bins % y_factor:
+        raise ValueError('x_factor and y_factor must divide the number of x and y bins')
+    
+    counts = count_cube['counts'].reshape(n_groups, x_bins // x_factor, x_factor, y_bins // y_factor, y_factor).sum(axis=(2, 4))
+    
+    coarse_cube = {'counts': counts,
+                   'groups': count_cube['groups'],
+                   'xedges': count_cube['xedges'][::x_factor],
+                   'yedges': count_cube['yedges'][::y_factor]}
+    
+    return coarse_cube
\ No newline at end of file
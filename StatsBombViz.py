@@ -1,37 +1,103 @@
 import numpy as np
-import seaborn as sns
 from CustomPitch import createVerticalPitch
+from Instrumentation import instrumented, stage, worker_function, worker_output
 
-def plot_sb_event_location(events_df, pitch_length = 120, pitch_width = 80, metric = 'yards', alpha = 0.7, event_colour = 'royalblue', pitch_theme='light', pitch_line_colour = 'black', ax_colour = 'white', figsize=(5, 10), figax=None):
+def add_event_arrow_collection(ax, x_start, y_start, x_end, y_end, colours = 'royalblue', alpha = 0.7, linewidth = 1.0, head_length = 4, head_width = 2):
+
+    '''
+    Draws event arrows onto an axes as two LineCollections, one for the shafts and one for the open arrow heads.
+    Replaces one annotate call per event, heads are sized in points to match the annotate "->" arrowstyle.
+    
+    Parameters:
+        ax (axes): axes to draw arrows on
+        x_start (array): horizontal, x start locations of events
+        y_start (array): vertical, y start locations of events
+        x_end (array): horizontal, x end locations of events
+        y_end (array): vertical, y end locations of events
+        colours (string or array): single colour or one colour per event
+        alpha (numeric): transparency of events, 0-1
+        linewidth (numeric): width of arrow lines in points
+        head_length (numeric): length of arrow heads in points
+        head_width (numeric): half width of arrow heads in points
+        
+    '''
+    
+    from matplotlib.collections import LineCollection
+    from matplotlib.transforms import Affine2D
+    
+    x_start = np.asarray(x_start, dtype=float)
+    y_start = np.asarray(y_start, dtype=float)
+    x_end = np.asarray(x_end, dtype=float)
+    y_end = np.asarray(y_end, dtype=float)
+    
+    shafts = np.stack([np.column_stack([x_start, y_start]), np.column_stack([x_end, y_end])], axis=1)
+    
+    # Arrow heads drawn in points around each end location, pitch axes use equal aspect so data angles hold
+    theta = np.arctan2(y_end - y_start, x_end - x_start)
+    cos_t, sin_t = np.cos(theta), np.sin(theta)
+    barb_x = -head_length * cos_t
+    barb_y = -head_length * sin_t
+    left = np.column_stack([barb_x - head_width * sin_t, barb_y + head_width * cos_t])
+    right = np.column_stack([barb_x + head_width * sin_t, barb_y - head_width * cos_t])
+    tip = np.zeros_like(left)
+    heads = np.stack([left, tip, right], axis=1)
+    
+    shaft_collection = LineCollection(shafts, colors=colours, linewidths=linewidth, alpha=alpha)
+    head_collection = LineCollection(heads, colors=colours, linewidths=linewidth, alpha=alpha,
+                                     offsets=np.column_stack([x_end, y_end]),
+                                     offset_transform=ax.transData,
+                                     transform=Affine2D().scale(1 / 72) + ax.figure.dpi_scale_trans)
+    # annotate arrows never change the axes limits, so skip the data limit update as well
+    ax.add_collection(shaft_collection, autolim=False)
+    ax.add_collection(head_collection, autolim=False)
+    
+    return shaft_collection, head_collection
+
+
+@instrumented
+def plot_sb_event_location(events_df, pitch_length = 120, pitch_width = 80, metric = 'yards', alpha = 0.7, event_colour = 'royalblue', pitch_theme='light', pitch_line_colour = 'black', ax_colour = 'white', figsize=(5, 10), figax=None, event_size = 36, max_points = None, gridsize = (16, 24), hexbin_colour_map = 'Reds', rasterized = False):
     
     '''
     Plots StatsBomb event data on a vertical pitch using transformed vertical locations.
+    All events are drawn as a single scatter collection, or as a hexbin density when there are more than max_points events.
     
     Parameters:
         events_df (dataframe): event dataframe with x and y vertical locations 
         pitch_length (integer): length of pitch in yards
         pitch_width (integer): width of pitch in yards
         metric (string): specify distance metric, yards (or metres - not yet available)
-        alpha (numeric): transparency of events, 0-1
-        event_colour (string): colour of events
+        alpha (numeric or array): transparency of events, 0-1, single value or one per event
+        event_colour (string or array): colour of events, single colour or one per event
         pitch_theme (string): specify 'light' or 'dark' to auto set pitch and line colours
         pitch_line_colour (string): specify colour for pitch lines
         ax_colour (string): specify colour for axes background colour
         figsize (tuple): specify (width, height) of figure
         figax (tuple): specify previous (fig, ax) to start from
+        event_size (numeric or array): marker area of events in points^2, single value or one per event
+        max_points (integer): number of events above which a hexbin density is drawn instead, None to always scatter
+        gridsize (tuple): number of (x, y) hexagons across the pitch for the hexbin density
+        hexbin_colour_map (string): Matplotlib colour map for the hexbin density
+        rasterized (boolean): rasterize events when saving to vector formats such as SVG/PDF
         
     '''
     
     
     fig,ax = createVerticalPitch(length=pitch_length, width=pitch_width, metric=metric, pitch_theme = pitch_theme, linecolor=pitch_line_colour, ax_colour = ax_colour, figsize = figsize, figax = figax) 
-    for index, event in events_df.iterrows():
-        x = event['vertical_location_x']
-        y = event['vertical_location_y']
-        ax.plot(x, y, 'ro', alpha = alpha)
+    
+    x = events_df['vertical_location_x'].to_numpy()
+    y = events_df['vertical_location_y'].to_numpy()
+    
+    if max_points is not None and len(events_df) > max_points:
+        ax.hexbin(x, y, gridsize = gridsize, extent = (0, pitch_width, 0, pitch_length), cmap = hexbin_colour_map,
+                  mincnt = 1, alpha = np.max(alpha), rasterized = rasterized)
+        return fig,ax
+    
+    ax.scatter(x, y, s = event_size, c = event_colour, alpha = alpha, rasterized = rasterized, zorder = 2)
     return fig,ax
 
 
-def plot_sb_events(events_df, pitch_length = 120, pitch_width = 80, metric = 'yards', alpha = 0.7, event_colour = 'royalblue', pitch_theme='light', pitch_line_colour = 'black', ax_colour = 'white', figsize=(5, 10), figax=None):
+@instrumented
+def plot_sb_events(events_df, pitch_length = 120, pitch_width = 80, metric = 'yards', alpha = 0.7, event_colour = 'royalblue', pitch_theme='light', pitch_line_colour = 'black', ax_colour = 'white', figsize=(5, 10), figax=None, render = 'annotate'):
     
     '''
     Plots StatsBomb event data on a vertical pitch using transformed vertical start and end locations.
@@ -48,10 +114,18 @@ def plot_sb_events(events_df, pitch_length = 120, pitch_width = 80, metric = 'ya
         ax_colour (string): specify colour for axes background colour
         figsize (tuple): specify (width, height) of figure
         figax (tuple): specify previous (fig, ax) to start from
+        render (string): specify 'annotate' for one arrow per event or 'collection' to draw all arrows in one batch
         
     '''
     
     fig,ax = createVerticalPitch(length=pitch_length, width=pitch_width, metric=metric, pitch_theme = pitch_theme, linecolor=pitch_line_colour, ax_colour = ax_colour, figsize = figsize, figax = figax) 
+    
+    if render == 'collection':
+        add_event_arrow_collection(ax, events_df['vertical_location_x'], events_df['vertical_location_y'],
+                                   events_df['vertical_end_location_x'], events_df['vertical_end_location_y'],
+                                   colours = event_colour, alpha = alpha)
+        return fig, ax
+    
     for index, event in events_df.iterrows():
         x_start = event['vertical_location_x']
         y_start = event['vertical_location_y']
@@ -65,11 +139,13 @@ def plot_sb_events(events_df, pitch_length = 120, pitch_width = 80, metric = 'ya
 
 
 
-def plot_sb_events_clusters(events_df, clusters=4, pitch_length = 120, pitch_width = 80, metric = 'yards', pitch_theme = 'light', line_colour = 'black', ax_colour = 'white', alpha = 0.7, figsize = (5, 10), figax=None):
+@instrumented
+def plot_sb_events_clusters(events_df, clusters=4, pitch_length = 120, pitch_width = 80, metric = 'yards', pitch_theme = 'light', line_colour = 'black', ax_colour = 'white', alpha = 0.7, figsize = (5, 10), figax=None, render = 'annotate', reference_centroids = None, cluster_model = None):
     
     '''
-    Applies k-means clustering to events with given number of clusters.
-    Then plots StatsBomb event data on a vertical pitch using transformed vertical start and end locations with random colours per cluster.
+    Applies k-means clustering to events with given number of clusters, or assigns them to the clusters of a fitted cluster model.
+    Then plots StatsBomb event data on a vertical pitch using transformed vertical start and end locations with a colour per cluster.
+    Colours follow the cluster locations rather than the label numbers, see cluster_colour_map().
     
     Parameters:
         events_df (dataframe): event dataframe with x and y vertical locations
@@ -84,16 +160,33 @@ def plot_sb_events_clusters(events_df, clusters=4, pitch_length = 120, pitch_wid
         ax_colour (string): specify colour for axes background colour
         figsize (tuple): specify (width, height) of figure
         figax (tuple): specify previous (fig, ax) to start from
+        render (string): specify 'annotate' for one arrow per event or 'collection' to draw all arrows in one batch
+        reference_centroids (array): cluster centroids of a previous plot to keep the colours of, see cluster_centroids()
+        cluster_model (dict): fitted cluster model to assign events with instead of refitting, see ClusterEval.fit_cluster_model()
         
     '''
     
-    from ClusterEval import kmeans_cluster, cluster_colour_map
+    from ClusterEval import kmeans_cluster, cluster_colour_map, cluster_centroids, predict_cluster_labels
     
-    cluster_labels = kmeans_cluster(events_df, clusters)
-    label_colour = cluster_colour_map(cluster_labels, clusters)
+    if cluster_model is not None:
+        clusters = len(cluster_model['centroids'])
+        cluster_labels = predict_cluster_labels(cluster_model, events_df)
+        # Model centroids are in scaled units, colours are ordered by pitch locations
+        centroids = cluster_model['centroids'] * cluster_model['scaler_scale'] + cluster_model['scaler_mean']
+    else:
+        cluster_labels = kmeans_cluster(events_df, clusters)
+        events_locations = events_df[['vertical_location_x', 'vertical_location_y', 'vertical_end_location_x', 'vertical_end_location_y']].to_numpy()
+        centroids = cluster_centroids(events_locations, cluster_labels, clusters)
+    label_colour = cluster_colour_map(cluster_labels, clusters, centroids=centroids, reference_centroids=reference_centroids)
     
     fig,ax = createVerticalPitch(length=pitch_length, width=pitch_width, metric=metric, pitch_theme = pitch_theme, linecolor=line_colour, ax_colour = ax_colour, figsize = figsize, figax = figax)
     
+    if render == 'collection':
+        add_event_arrow_collection(ax, events_df['vertical_location_x'], events_df['vertical_location_y'],
+                                   events_df['vertical_end_location_x'], events_df['vertical_end_location_y'],
+                                   colours = label_colour, alpha = alpha)
+        return fig, ax, cluster_labels
+    
     cluster_colour=0
     for index, event in events_df.iterrows():
         x_start = event['vertical_location_x']
@@ -107,11 +200,13 @@ def plot_sb_events_clusters(events_df, clusters=4, pitch_length = 120, pitch_wid
     
     return fig, ax, cluster_labels
 
-def plot_individual_cluster_events(rows, cols, events_df, cluster_labels, sample_size = 5, pitch_length=120, pitch_width=80, pitch_theme = 'dark', line_colour='white', ax_colour = '#303030', event_colour='royalblue', figsize=(10, 16)):
+@instrumented
+def plot_individual_cluster_events(rows, cols, events_df, cluster_labels, sample_size = 5, pitch_length=120, pitch_width=80, pitch_theme = 'dark', line_colour='white', ax_colour = '#303030', event_colour='royalblue', figsize=(10, 16), random_state = None, render = 'collection'):
     
     '''
     Creates figure and axes grid using specified rows x columns.
-    Plots each cluster of StatsBomb event data on a separate pitch with specified number of sample events.
+    Plots each cluster of StatsBomb event data on a separate pitch with specified number of sample events, largest clusters first.
+    Events are grouped by sorting the labels once, clusters smaller than sample_size are plotted in full.
     
     Parameters:
         rows (integer): number of rows in axes grid 
@@ -128,25 +223,34 @@ def plot_individual_cluster_events(rows, cols, events_df, cluster_labels, sample
         pitch_line_colour (string): specify colour for pitch lines
         ax_colour (string): specify colour for axes background colour
         figsize (tuple): specify (width, height) of figure
+        random_state (integer): seed for sampling events, None to use NumPy's global random state
+        render (string): specify 'annotate' for one arrow per event or 'collection' to draw all arrows in one batch
         
     '''
     import matplotlib.pyplot as plt
-    import collections
                               
     fig, axs = plt.subplots(rows,cols, sharex = True, sharey = True, figsize = figsize)
     
     if pitch_theme == 'dark':
         fig.patch.set_facecolor('#303030')
     
+    # Sort events by label once, each cluster is then a slice of the sorted index
+    cluster_labels = np.asarray(cluster_labels)
+    label_order = np.argsort(cluster_labels, kind='stable')
+    cluster_freq = np.bincount(cluster_labels)
+    cluster_start = np.concatenate([[0], np.cumsum(cluster_freq)[:-1]])
+    cluster_sorted = np.argsort(-cluster_freq, kind='stable')
+    cluster_sorted = cluster_sorted[cluster_freq[cluster_sorted] > 0]
     
-    cluster_freq = collections.Counter(cluster_labels)
-    cluster_sorted = list(zip(*cluster_freq.most_common()))[0]
-    cluster_freq_sorted = list(zip(*cluster_freq.most_common()))[1]
+    # Without a seed use NumPy's global random state, so np.random.seed() before the call still fixes the samples
+    rng = np.random if random_state is None else np.random.default_rng(random_state)
 
-    for ax, cluster, event_count in zip(axs.flat, cluster_sorted, cluster_freq_sorted):
-        cluster_events = events_df[cluster_labels == cluster].sample(sample_size)
-        createVerticalPitch(length=pitch_length, width=pitch_width, metric='yards', pitch_theme = pitch_theme, linecolor=line_colour, ax_colour = ax_colour, figsize = figsize, figax = (fig, ax))
-        plot_sb_events(cluster_events, figax = (fig, ax), pitch_theme=pitch_theme, event_colour=event_colour)
+    for ax, cluster in zip(np.ravel(axs), cluster_sorted):
+        event_count = cluster_freq[cluster]
+        cluster_index = label_order[cluster_start[cluster]:cluster_start[cluster] + event_count]
+        cluster_events = events_df.iloc[np.sort(rng.choice(cluster_index, min(sample_size, event_count), replace=False))]
+        plot_sb_events(cluster_events, figax = (fig, ax), pitch_length=pitch_length, pitch_width=pitch_width, pitch_theme=pitch_theme,
+                       pitch_line_colour=line_colour, ax_colour=ax_colour, event_colour=event_colour, render=render)
         ax.set_title("Cluster " + str(cluster+1) + " - (" + str(event_count) + ")",
                      fontdict = dict(fontweight='bold',
                                      color='white'))
@@ -157,46 +261,121 @@ def plot_individual_cluster_events(rows, cols, events_df, cluster_labels, sample
     return fig, axs
 
 
-def marginal_dist_grid(x, y, ax, ax_x, ax_y, nbins = 6, grid_colour_map = 'Reds', bar_colour = 'Red'):
+def marginal_densities(histogram, xedges, yedges):
+
+    '''
+    Calculates the x and y marginal densities of a 2D histogram by summing its counts along each axis.
+    Each density integrates to 1 over its bins, as a normalised histogram would.
+    
+    Parameters:
+        histogram (array): 2D histogram of counts
+        xedges (array): x bin edges
+        yedges (array): y bin edges
+
+    '''
+    
+    total = max(histogram.sum(), 1)
+    x_density = histogram.sum(axis=1) / (total * np.diff(xedges))
+    y_density = histogram.sum(axis=0) / (total * np.diff(yedges))
+    
+    return x_density, y_density
+
+
+def binned_kde(values, low, high, bandwidth=5, bin_size=1):
+
+    '''
+    Estimates a 1D Gaussian kernel density on a fine grid by smoothing binned counts instead of evaluating every point.
+    Returns (grid, density) with grid at the bin centres.
+    
+    Parameters:
+        values (Series): locations of events, NaN values are ignored
+        low (numeric): lower end of the grid
+        high (numeric): upper end of the grid
+        bandwidth (numeric): kernel standard deviation in the units of values
+        bin_size (numeric): grid spacing in the units of values
+
+    '''
+    
+    edges = np.linspace(low, high, int(round((high - low) / bin_size)) + 1)
+    counts, edges = np.histogram(values, bins=edges)
+    
+    sigma = bandwidth / (edges[1] - edges[0])
+    radius = int(np.ceil(3 * sigma))
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+    kernel /= kernel.sum()
+    
+    full = np.convolve(counts, kernel)
+    density = full[radius:radius + len(counts)] / (max(counts.sum(), 1) * (edges[1] - edges[0]))
+    
+    return (edges[:-1] + edges[1:]) / 2, density
+
+
+def marginal_dist_grid(x, y, ax, ax_x, ax_y, nbins = 6, grid_colour_map = 'Reds', bar_colour = 'Red', histogram = None, kde_bandwidth = None):
         
     '''
     Create a figure with three axes, 2D histogram with density plots along top and right side.
+    The densities are the 2D histogram counts summed along each axis, drawn as a single filled step artist each,
+    so drawing time does not depend on the number of events.
     
     Parameters:
-        x (Series): horizontal, x locations of events
-        y (Series): vertical, y locations of events
+        x (Series): horizontal, x locations of events, only needed without a histogram or with kde_bandwidth
+        y (Series): vertical, y locations of events, only needed without a histogram or with kde_bandwidth
         ax (axes): ax for 2D histogram
         ax_x (axes): ax for density plot on top
         ax_y (axes): ax for density plot on right
         nbins (integer): number of bins for 2D histogram
         grid_colour_map (string): Matplotlib colour map
         bar_colour (string): colour of density plot bars
-    ...
-    ...
+        histogram (tuple): (histogram, xedges, yedges) to use instead of binning x and y, e.g. from pitch_histogram()
+        kde_bandwidth (numeric): if given, also draw a binned kernel density line with this bandwidth, see binned_kde(),
+                                 x and y must then be the events the histogram was binned from
     
     '''
+    
+    if histogram is None:
+        histogram = np.histogram2d(x, y, bins=nbins)
+    h, xedges, yedges = histogram
+    
     # the hist grid
-    ax.hist2d(x, y, bins=nbins, cmap = grid_colour_map)
+    ax.pcolorfast(xedges, yedges, h.T, cmap = grid_colour_map)
+    
+    x_density, y_density = marginal_densities(h, xedges, yedges)
     
     # the top distribution
-    sns.distplot(x, color = bar_colour, ax=ax_x)
+    ax_x.stairs(x_density, xedges, fill=True, color=bar_colour, alpha=0.4)
     ax_x.patch.set_alpha(0)
     ax_x.axis('off')
     # the right distribution
-    sns.distplot(y, color=bar_colour, vertical=True, ax=ax_y)
+    ax_y.stairs(y_density, yedges, orientation='horizontal', fill=True, color=bar_colour, alpha=0.4)
     ax_y.patch.set_alpha(0)
     ax_y.axis('off')
     
+    if kde_bandwidth is not None:
+        if x is None or y is None:
+            raise ValueError('kde_bandwidth needs the x and y locations of the events in the histogram')
+        # Only events inside the bins, which must be the events counted, so the lines and the bars agree
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        in_bins = (x >= xedges[0]) & (x <= xedges[-1]) & (y >= yedges[0]) & (y <= yedges[-1])
+        if in_bins.sum() != h.sum():
+            raise ValueError('x and y do not match the histogram, pass the events the histogram was binned from')
+        x, y = x[in_bins], y[in_bins]
+        x_grid, x_kde = binned_kde(x, xedges[0], xedges[-1], bandwidth=kde_bandwidth)
+        y_grid, y_kde = binned_kde(y, yedges[0], yedges[-1], bandwidth=kde_bandwidth)
+        ax_x.plot(x_grid, x_kde, color=bar_colour)
+        ax_y.plot(y_kde, y_grid, color=bar_colour)
+    
     return ax, ax_x, ax_y
     
 
-def plot_sb_event_grid_density_pitch(events_df, pitch_length = 120, pitch_width = 80, metric = 'yards', pitch_line_colour='black',spacing = 0.005, nbins = 6, grid_colour_map = 'Reds', bar_colour = 'Red', figsize=(5, 10)):
+@instrumented
+def plot_sb_event_grid_density_pitch(events_df, pitch_length = 120, pitch_width = 80, metric = 'yards', pitch_line_colour='black',spacing = 0.005, nbins = 6, grid_colour_map = 'Reds', bar_colour = 'Red', figsize=(5, 10), histogram = None, kde_bandwidth = None):
 
     '''
     Plot a 2D histogram of event locations with marginal density plots both vertically and horizontally.
     
     Parameters:
-        events_df (dataframe): event dataframe with x and y vertical locations
+        events_df (dataframe): event dataframe with x and y vertical locations, None when histogram is given without kde_bandwidth
         pitch_length (integer): length of pitch in yards
         pitch_width (integer): width of pitch in yards
         metric (string): specify distance metric, yards (or metres - not yet available)
@@ -205,11 +384,16 @@ def plot_sb_event_grid_density_pitch(events_df, pitch_length = 120, pitch_width
         grid_colour_map (string): Matplotlib colour map
         bar_colour (string): colour of density plot bars
         figsize (tuple): specify (width, height) of figure
+        histogram (tuple): (histogram, xedges, yedges) to use instead of binning events_df, e.g. from count_cube_histogram()
+        kde_bandwidth (numeric): if given, also draw binned kernel density lines with this bandwidth in yards,
+                                 events_df must then hold the events the histogram was binned from
         
     '''
     
-    x = events_df['vertical_location_x']
-    y = events_df['vertical_location_y']
+    if histogram is None:
+        histogram = pitch_histogram(events_df, pitch_length, pitch_width, nbins=nbins)
+    
+    x, y = (None, None) if events_df is None else (events_df['vertical_location_x'], events_df['vertical_location_y'])
     
     fig, ax = createVerticalPitch(pitch_length, pitch_width, metric, linecolor=pitch_line_colour, figsize = figsize)
     ax_pos = ax.get_position()
@@ -223,13 +407,118 @@ def plot_sb_event_grid_density_pitch(events_df, pitch_length = 120, pitch_width
     ax_histx = fig.add_axes(rect_histx, sharex=ax)
     ax_histy = fig.add_axes(rect_histy, sharey=ax)
 
-    ax, ax_x, ax_y = marginal_dist_grid(x, y, ax, ax_histx, ax_histy, nbins = nbins, grid_colour_map = grid_colour_map, bar_colour = bar_colour)
+    ax, ax_x, ax_y = marginal_dist_grid(x, y, ax, ax_histx, ax_histy, nbins = nbins, grid_colour_map = grid_colour_map, bar_colour = bar_colour,
+                                        histogram = histogram, kde_bandwidth = kde_bandwidth)
 
     return fig, ax, ax_x, ax_y
 
-def plot_histogram_ratio_pitch(events_1, events_2, pitch_length=120, pitch_width=80, metric='yards', line_colour='black', nbins=6, grid_colour_map='RdBu', figsize=(5, 10)):
+def pitch_histogram(events_df, pitch_length=120, pitch_width=80, nbins=6, bin_size=None):
+
+    '''
+    Bins event locations on explicit pitch edges, so histograms of different events always share the same bins.
+    Returns (histogram, xedges, yedges) like np.histogram2d, events without a location or off the pitch are not counted.
+    
+    Parameters:
+        events_df (dataframe): event dataframe with x and y vertical locations
+        pitch_length (integer): length of pitch in yards
+        pitch_width (integer): width of pitch in yards
+        nbins (integer or tuple): number of bins in both directions, or (x bins, y bins)
+        bin_size (numeric): size of square bins in yards, overrides nbins when given
+
+    '''
+    
+    if bin_size is not None:
+        nbins = (int(round(pitch_width / bin_size)), int(round(pitch_length / bin_size)))
+    elif np.ndim(nbins) == 0:
+        nbins = (nbins, nbins)
+    
+    xedges = np.linspace(0, pitch_width, nbins[0] + 1)
+    yedges = np.linspace(0, pitch_length, nbins[1] + 1)
+    histogram, xedges, yedges = np.histogram2d(events_df['vertical_location_x'], events_df['vertical_location_y'], bins=[xedges, yedges])
+    
+    return histogram, xedges, yedges
+
+
+def gaussian_smooth_histogram(histogram, xedges, yedges, bandwidth=5):
+
+    '''
+    Smooths a 2D histogram with a Gaussian kernel, a binned kernel density estimate of the counts.
+    The kernel is separable, so rows then columns are convolved directly, bins out of the kernel's reach stay exactly 0.
+    Counts smoothed off the pitch are dropped, so ratios of histograms smoothed the same way are unaffected at the edges.
+    
+    Parameters:
+        histogram (array): 2D histogram of counts
+        xedges (array): x bin edges
+        yedges (array): y bin edges
+        bandwidth (numeric): kernel standard deviation in yards
+
+    '''
+    
+    smoothed = np.asarray(histogram, dtype=float)
+    
+    for axis, bin_width in [(0, xedges[1] - xedges[0]), (1, yedges[1] - yedges[0])]:
+        sigma = bandwidth / bin_width
+        radius = int(np.ceil(3 * sigma))
+        kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) / sigma) ** 2)
+        kernel /= kernel.sum()
+        # Full convolution cropped back to the pitch, an FFT would leave round-off noise in the empty bins
+        smoothed = np.apply_along_axis(lambda line: np.convolve(line, kernel)[radius:radius + len(line)], axis, smoothed)
+    
+    return smoothed
+
+
+def histogram_ratio(histogram_1, histogram_2, xedges, yedges, method='raw', bandwidth=5, prior_strength=10, min_density=None):
+
+    '''
+    Calculates the ratio of two 2D histograms on the same bins without divide by zero warnings.
+    
+    Methods:
+        raw: ratio of counts, bins with no events in histogram_2 are NaN
+        kde: ratio of Gaussian smoothed counts, see gaussian_smooth_histogram()
+        shrinkage: ratio of counts shrunk towards the overall ratio, (h1 + a * r) / (h2 + a) for prior strength a
+                   and overall ratio r, so sparse bins stay near r and empty bins equal r
+    
+    Parameters:
+        histogram_1 (array): 2D histogram of counts, the numerator
+        histogram_2 (array): 2D histogram of counts, the denominator
+        xedges (array): x bin edges shared by both histograms
+        yedges (array): y bin edges shared by both histograms
+        method (string): specify 'raw', 'kde' or 'shrinkage'
+        bandwidth (numeric): kernel standard deviation in yards for 'kde'
+        prior_strength (numeric): number of pseudo events pulling each bin to the overall ratio for 'shrinkage'
+        min_density (numeric): smallest denominator, in events per bin after smoothing, to calculate a ratio for,
+                               None for any denominator above 0
+
+    '''
+    
+    histogram_1 = np.asarray(histogram_1, dtype=float)
+    histogram_2 = np.asarray(histogram_2, dtype=float)
+    
+    if method == 'kde':
+        histogram_1 = gaussian_smooth_histogram(histogram_1, xedges, yedges, bandwidth)
+        histogram_2 = gaussian_smooth_histogram(histogram_2, xedges, yedges, bandwidth)
+    elif method == 'shrinkage':
+        overall_ratio = histogram_1.sum() / max(histogram_2.sum(), 1)
+        histogram_1 = histogram_1 + prior_strength * overall_ratio
+        histogram_2 = histogram_2 + prior_strength
+    elif method != 'raw':
+        raise ValueError("method must be 'raw', 'kde' or 'shrinkage'")
+    
+    if min_density is None:
+        valid = histogram_2 > 0
+    else:
+        valid = (histogram_2 >= min_density) & (histogram_2 > 0)
+    ratio = np.divide(histogram_1, histogram_2, out=np.full(histogram_1.shape, np.nan), where=valid)
+    
+    return ratio
+
+
+@instrumented
+def plot_histogram_ratio_pitch(events_1, events_2, pitch_length=120, pitch_width=80, metric='yards', line_colour='black', nbins=6, grid_colour_map='RdBu', figsize=(5, 10), histogram_1=None, histogram_2=None, bin_size=None, ratio_method='raw', bandwidth=5, prior_strength=10, min_density=None):
     '''
     Calculate and plot the ratio of two 2D histograms with specified number of bins.
+    Both events are binned on the same pitch edges, bins with no ratio are left blank, see histogram_ratio().
+    Precomputed histograms, e.g. from count_cube_histogram(), can be given instead of events to skip binning.
     
     Parameters:
         events_1 (dataframe): event dataframe with x and y vertical locations
@@ -238,20 +527,173 @@ def plot_histogram_ratio_pitch(events_1, events_2, pitch_length=120, pitch_width
         pitch_width (integer): width of pitch in yards
         metric (string): specify distance metric, yards (or metres - not yet available)
         pitch_line_colour (string): specify colour for pitch lines
-        nbins (integer): number of bins for 2D histogram
+        nbins (integer or tuple): number of bins for 2D histogram, or (x bins, y bins)
         grid_colour_map (string): Matplotlib colour map
         figsize (tuple): specify (width, height) of figure
+        histogram_1 (tuple): (histogram, xedges, yedges) to use instead of events_1
+        histogram_2 (tuple): (histogram, xedges, yedges) to use instead of events_2, with the same edges as histogram_1
+        bin_size (numeric): size of square bins in yards, overrides nbins when given
+        ratio_method (string): specify 'raw', 'kde' or 'shrinkage'
+        bandwidth (numeric): kernel standard deviation in yards for 'kde'
+        prior_strength (numeric): number of pseudo events pulling each bin to the overall ratio for 'shrinkage'
+        min_density (numeric): smallest denominator, in events per bin after smoothing, to calculate a ratio for
     '''  
     
-    x1, y1 = events_1['vertical_location_x'], events_1['vertical_location_y']
-    x2, y2 = events_2['vertical_location_x'], events_2['vertical_location_y']
+    if histogram_1 is None:
+        histogram_1 = pitch_histogram(events_1, pitch_length, pitch_width, nbins=nbins, bin_size=bin_size)
+    if histogram_2 is None:
+        histogram_2 = pitch_histogram(events_2, pitch_length, pitch_width, nbins=nbins, bin_size=bin_size)
     
-    h1, xedges, yedges = np.histogram2d(x1, y1, bins=nbins)
-    h2, xedges, yedges = np.histogram2d(x2, y2, bins=nbins)
-    h = -1 * (h1 / h2)
+    h1, xedges, yedges = histogram_1
+    h2, xedges, yedges = histogram_2
+    h = -1 * histogram_ratio(h1, h2, xedges, yedges, method=ratio_method, bandwidth=bandwidth, prior_strength=prior_strength,
+                                 min_density=min_density)
     
     fig, ax = createVerticalPitch(pitch_length, pitch_width, metric, linecolor=line_colour, figsize = figsize)
-    ax.pcolorfast(xedges, yedges, h.T, cmap=grid_colour_map)
+    ax.pcolorfast(xedges, yedges, np.ma.masked_invalid(h.T), cmap=grid_colour_map)
     
     return fig, ax
 
+
+def render_figure_task(task, output_dir, formats=('png',), dpi=100):
+
+    '''
+    Renders one figure task and saves it straight to disk in each format, then closes the figure.
+    Returns a list of manifest rows, one per format, errors are recorded in the rows instead of raised.
+    
+    Parameters:
+        task (dict): {'name': file name without extension, 'function': plotting function returning fig first, or the name of a
+                      StatsBombViz function, 'args': tuple of arguments, 'kwargs': dict of keyword arguments}
+        output_dir (string): directory to save figures in
+        formats (tuple): file formats to save, e.g. ('png', 'svg')
+        dpi (integer): resolution of raster formats
+
+    '''
+    
+    import os
+    import time
+    import matplotlib.pyplot as plt
+    
+    function = task.get('function')
+    function_name = function if isinstance(function, str) else getattr(function, '__name__', str(function))
+    
+    rows = []
+    start = time.perf_counter()
+    fig = None
+    try:
+        if isinstance(function, str):
+            function = globals()[function]
+        fig = function(*task.get('args', ()), **task.get('kwargs', {}))[0]
+        plot_seconds = time.perf_counter() - start
+        for file_format in formats:
+            path = os.path.join(output_dir, task['name'] + '.' + file_format)
+            save_start = time.perf_counter()
+            with stage('Save Figure', figure=task['name'], format=file_format):
+                fig.savefig(path, format=file_format, dpi=dpi)
+            rows.append({'Name': task['name'], 'Function': function_name, 'Format': file_format, 'Path': path,
+                         'Bytes': os.path.getsize(path), 'Plot Seconds': plot_seconds,
+                         'Save Seconds': time.perf_counter() - save_start, 'Error': None})
+    except Exception as error:
+        rows.append({'Name': task.get('name'), 'Function': function_name, 'Format': None, 'Path': None, 'Bytes': None,
+                     'Plot Seconds': time.perf_counter() - start, 'Save Seconds': None, 'Error': repr(error)})
+    finally:
+        if fig is not None:
+            plt.close(fig)
+    
+    try:
+        import resource
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        peak_mb = None
+    for row in rows:
+        row['Process'] = os.getpid()
+        row['Process Peak MB'] = peak_mb
+    
+    return rows
+
+
+def use_agg_backend():
+
+    '''
+    Switches Matplotlib to the non-interactive Agg backend, used to set up batch rendering worker processes.
+    '''
+    
+    import matplotlib.pyplot as plt
+    
+    plt.switch_backend('Agg')
+
+
+@instrumented
+def render_figures(tasks, output_dir, formats=('png',), dpi=100, n_jobs=1, manifest_file='manifest.csv', tasks_per_worker=None):
+
+    '''
+    Batch renders figures on the Agg backend, one figure per task, saving each to disk as soon as it is drawn.
+    Tasks are taken from the iterable a few at a time and the manifest is appended to as each task finishes,
+    so memory stays flat however many figures are rendered. Tasks can be a generator to avoid building every task up front.
+    
+    Parameters:
+        tasks (iterable): task dicts, see render_figure_task()
+        output_dir (string): directory to save figures and manifest in, created if needed
+        formats (tuple): file formats to save, e.g. ('png', 'svg')
+        dpi (integer): resolution of raster formats
+        n_jobs (integer): number of worker processes, 1 to render in this process, -1 to use all cores
+        manifest_file (string): name of csv manifest of outputs and timings in output_dir, None to not write it
+        tasks_per_worker (integer): replace each worker process after this many tasks, None to keep workers
+
+    '''
+    
+    import os
+    import csv
+    import pandas as pd
+    import matplotlib
+    from itertools import islice
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    
+    columns = ['Name', 'Function', 'Format', 'Path', 'Bytes', 'Plot Seconds', 'Save Seconds', 'Error', 'Process', 'Process Peak MB']
+    
+    os.makedirs(output_dir, exist_ok=True)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    
+    manifest_rows = []
+    manifest = None
+    if manifest_file is not None:
+        manifest = open(os.path.join(output_dir, manifest_file), 'w', newline='')
+        writer = csv.DictWriter(manifest, fieldnames=columns)
+        writer.writeheader()
+    
+    def record(rows):
+        manifest_rows.extend(rows)
+        if manifest is not None:
+            writer.writerows(rows)
+            manifest.flush()
+    
+    try:
+        if n_jobs == 1:
+            original_backend = matplotlib.get_backend()
+            use_agg_backend()
+            try:
+                for task in tasks:
+                    record(render_figure_task(task, output_dir, formats, dpi))
+            finally:
+                import matplotlib.pyplot as plt
+                plt.switch_backend(original_backend)
+        else:
+            tasks = iter(tasks)
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=use_agg_backend,
+                                     max_tasks_per_child=tasks_per_worker) as executor:
+                # Keep only a couple of tasks per worker in flight, rather than pickling every task at once
+                render_task = worker_function(render_figure_task)
+                pending = {executor.submit(render_task, task, output_dir, formats, dpi)
+                           for task in islice(tasks, 2 * n_jobs)}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        record(worker_output(future.result()))
+                    pending |= {executor.submit(render_task, task, output_dir, formats, dpi)
+                                for task in islice(tasks, len(done))}
+    finally:
+        if manifest is not None:
+            manifest.close()
+    
+    return pd.DataFrame(manifest_rows, columns=columns)